@@ -26,11 +26,12 @@ from datetime import datetime
 from pathlib import Path
 
 DB_PATH = Path(__file__).parent / "data" / "replays.db"
+MATCH_ID_RE = re.compile(r'(MM-[0-9A-Fa-f-]+)')
 
 
 def extract_match_id(file_name: str) -> str:
     """Extract MM-XXXXXXXX match_id from replay filename."""
-    m = re.search(r'(MM-[0-9A-Fa-f-]+)', file_name)
+    m = MATCH_ID_RE.search(file_name)
     return m.group(1) if m else None
 
 
@@ -60,16 +61,14 @@ def tier1_seed_identities(conn):
     """)
     alias_rows = c.fetchall()
 
-    inserted = 0
-    for canonical, aurora_id in alias_rows:
-        c.execute("SELECT id FROM player_identities WHERE aurora_id = ?", (aurora_id,))
-        if c.fetchone():
-            continue
-        c.execute("""
-            INSERT INTO player_identities (canonical_name, aurora_id, source, created_at)
-            VALUES (?, ?, 'backfill_from_aliases', ?)
-        """, (canonical, aurora_id, datetime.now().isoformat()))
-        inserted += 1
+    # aurora_id is UNIQUE: OR IGNORE skips ids that already have an identity
+    # (first alias row wins) without a lookup query per row
+    created_at = datetime.now().isoformat()
+    c.executemany("""
+        INSERT OR IGNORE INTO player_identities (canonical_name, aurora_id, source, created_at)
+        VALUES (?, ?, 'backfill_from_aliases', ?)
+    """, [(canonical, aurora_id, created_at) for canonical, aurora_id in alias_rows])
+    inserted = c.rowcount
 
     conn.commit()
     print(f"  Seeded {inserted} player_identities ({len(alias_rows)} alias aurora_ids found)")
@@ -87,13 +86,12 @@ def tier1_backfill_players_by_name(conn):
     """)
     alias_map = c.fetchall()
 
-    total_updated = 0
-    for alias, aurora_id in alias_map:
-        c.execute("""
-            UPDATE players SET aurora_id = ?
-            WHERE player_name = ? AND aurora_id IS NULL
-        """, (aurora_id, alias))
-        total_updated += c.rowcount
+    # One prepared statement for every alias; rowcount sums the updates
+    c.executemany("""
+        UPDATE players SET aurora_id = ?
+        WHERE player_name = ? AND aurora_id IS NULL
+    """, [(aurora_id, alias) for alias, aurora_id in alias_map])
+    total_updated = c.rowcount
 
     conn.commit()
     print(f"  Updated {total_updated} player rows by name match ({len(alias_map)} aliases)")
@@ -198,7 +196,7 @@ def tier3_direct_lookup(conn):
     """
     sys.path.insert(0, str(Path(__file__).parent))
     import requests
-    from cwal import SUPABASE_URL, get_headers
+    from cwal import SUPABASE_URL, API_HEADERS
 
     c = conn.cursor()
 
@@ -236,7 +234,7 @@ def tier3_direct_lookup(conn):
             "limit": 5000,
         }
         try:
-            resp = requests.get(url, headers=get_headers(), params=params, timeout=30)
+            resp = requests.get(url, headers=API_HEADERS, params=params, timeout=30)
             resp.raise_for_status()
             for row in resp.json():
                 alias = row["alias"]
@@ -275,7 +273,7 @@ def tier4_match_lookup(conn):
     the ladder can be resolved if they appear in any recorded match.
     """
     import requests
-    from cwal import SUPABASE_URL, get_headers
+    from cwal import SUPABASE_URL, API_HEADERS
 
     c = conn.cursor()
 
@@ -315,7 +313,7 @@ def tier4_match_lookup(conn):
             "limit": 5000,
         }
         try:
-            resp = requests.get(url, headers=get_headers(), params=params, timeout=60)
+            resp = requests.get(url, headers=API_HEADERS, params=params, timeout=60)
             resp.raise_for_status()
             rows = resp.json()
             api_hits += len(rows)
@@ -451,6 +449,8 @@ def main():
     except sqlite3.OperationalError:
         pass
     c.execute('CREATE INDEX IF NOT EXISTS idx_player_aurora_id ON players(aurora_id)')
+    # Covers the per-pro replay lookups and game counts (aurora_id IN (...) AND is_human = 1)
+    c.execute('CREATE INDEX IF NOT EXISTS idx_player_aurora_human ON players(aurora_id, is_human, replay_id, player_name)')
     c.execute('CREATE INDEX IF NOT EXISTS idx_replay_match_id ON replays(match_id)')
     _init_conn.commit()
     _init_conn.close()
@@ -2,15 +2,26 @@
 """cwal.gg ladder API tool for Barcode Reader."""
 
 import argparse
+import hashlib
 import json
+import os
 import re
+import shutil
 import sqlite3
+import sys
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
+from urllib.parse import urlencode
 
 import requests
 from pathlib import Path
 
+try:
+    import orjson  # optional: faster JSON decode/encode
+except ImportError:
+    orjson = None
+
 # cwal.gg Supabase config (public anon key)
 SUPABASE_URL = "https://xmploueumzkrdvapbyfs.supabase.co"
 SUPABASE_KEY = (
@@ -25,25 +36,61 @@ DEFAULT_LIMIT = 50
 PAGE_SIZE = 50  # Supabase page size
 API_PAGE_DELAY = 0.5  # seconds between API pages
 DOWNLOAD_DELAY = 0.15  # seconds between replay downloads
+DOWNLOAD_CHUNK_SIZE = 64 * 1024  # bytes per streamed read when saving replays
+DOWNLOAD_WORKERS = 8  # concurrent replay downloads
+SQL_IN_BATCH = 500  # max match_ids per IN (...) lookup
+HANDLES_BATCH = 100  # battlenet_accounts per bulk handles request (URL length)
+
+# Columns download_matches actually reads — narrow projection for scrape paths
+SCRAPE_SELECT = ("id,replay_url,alias,opponent_alias,matchup,result,"
+                 "aurora_id,opponent_aurora_id,gateway,timestamp")
+
+# Request headers never change — build once, don't mutate (copy to add per-call headers)
+API_HEADERS = {
+    "apikey": SUPABASE_KEY,
+    "Authorization": f"Bearer {SUPABASE_KEY}",
+    "Accept-Profile": "public",
+    "Content-Type": "application/json",
+}
+COUNT_HEADERS = {**API_HEADERS, "Prefer": "count=exact"}
+
+# Shared connection pool (keep-alive + TLS reuse) for the API and replay hosts.
+# Headers stay per-request so the Supabase key never goes to the replay host.
+SESSION = requests.Session()
+SESSION.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=DOWNLOAD_WORKERS + 2))
 
 GATEWAY_NAMES = {10: "US West", 11: "US West", 20: "US East", 30: "Korea", 45: "Europe"}
+SCRAPE_GATEWAYS = [30, 10, 20, 45]  # major gateways scraped by scrape-date
 
 OUTPUT_DIR = Path(__file__).parent / "data" / "to_ingest"
 DB_PATH = Path(__file__).parent / "data" / "replays.db"
 LEDGER_PATH = Path(__file__).parent / "docs" / "scrape_ledger.md"
+API_CACHE_DIR = Path(__file__).parent / "data" / "api_cache"
+
+# On-disk response cache lifetime per table (seconds) — see api_get
+API_CACHE_TTL = {"player_matches": 60, "rankings_view": 300, "players": 3600}
+
+# Map name cleanup (applied to every match row, so built once here)
+CONTROL_CHARS_TABLE = dict.fromkeys(range(32))  # BW color codes \x00-\x1f -> deleted
+LEADING_PLAYER_COUNT_RE = re.compile(r'^\(\d+\)')  # "(4)Pole Star" -> "Pole Star"
 
 
 # ---------------------------------------------------------------------------
 # Shared helpers
 # ---------------------------------------------------------------------------
 
-def get_headers():
-    return {
-        "apikey": SUPABASE_KEY,
-        "Authorization": f"Bearer {SUPABASE_KEY}",
-        "Accept-Profile": "public",
-        "Content-Type": "application/json",
-    }
+def json_loads(data):
+    """Decode JSON bytes (orjson if installed, else stdlib)."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def json_dumps(obj):
+    """Encode an object as a JSON string (orjson if installed, else stdlib)."""
+    if orjson is not None:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj)
 
 
 def parse_duration(s):
@@ -69,7 +116,7 @@ def clean_map_name(raw):
     """Strip BW color codes (control chars) from map names."""
     if not raw:
         return None
-    return re.sub(r'[\x00-\x1f]', '', raw)
+    return raw.translate(CONTROL_CHARS_TABLE)
 
 
 def get_map_display(match):
@@ -82,13 +129,18 @@ def get_map_display(match):
             if mfn.lower().endswith(ext):
                 mfn = mfn[:-len(ext)]
         # Strip leading (N) player count
-        mfn = re.sub(r'^\(\d+\)', '', mfn).strip()
+        mfn = LEADING_PLAYER_COUNT_RE.sub('', mfn).strip()
         if mfn:
             return mfn
     # Fallback to cleaned map_name
     return clean_map_name(match.get("map_name")) or "—"
 
 
+def write_lines(lines):
+    """Write table rows to stdout in one call instead of a print per row."""
+    sys.stdout.write("\n".join(lines) + "\n")
+
+
 def format_date(ts):
     """Format ISO timestamp as YYYY-MM-DD."""
     if not ts:
@@ -100,6 +152,60 @@ def format_date(ts):
 # API functions (return raw JSON, reusable from other scripts)
 # ---------------------------------------------------------------------------
 
+def api_get(table, params):
+    """GET a Supabase REST table and decode the JSON body.
+
+    Responses are cached on disk under API_CACHE_DIR, keyed by the full query,
+    for API_CACHE_TTL[table] seconds — repeated CLI runs skip the round-trip.
+    """
+    url = f"{SUPABASE_URL}/rest/v1/{table}"
+    ttl = API_CACHE_TTL.get(table, 0)
+    cache_path = None
+    if ttl:
+        key = hashlib.sha1(f"{url}?{urlencode(params)}".encode()).hexdigest()
+        cache_path = API_CACHE_DIR / f"{key}.json"
+        try:
+            if time.time() - cache_path.stat().st_mtime < ttl:
+                return json_loads(cache_path.read_bytes())
+            cache_path.unlink()  # expired: drop it even if the refetch below fails
+        except FileNotFoundError:
+            pass
+
+    resp = SESSION.get(url, headers=API_HEADERS, params=params)
+    resp.raise_for_status()
+    if cache_path is not None:
+        # Write-then-rename so a killed run or a concurrent cwal process never
+        # leaves / reads a partial entry
+        API_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        tmp_path = cache_path.with_suffix(f".{os.getpid()}.tmp")
+        tmp_path.write_bytes(resp.content)
+        os.replace(tmp_path, cache_path)
+    return json_loads(resp.content)
+
+
+def clear_api_cache():
+    """Delete all cached API responses."""
+    if API_CACHE_DIR.exists():
+        for path in API_CACHE_DIR.glob("*.json"):
+            path.unlink(missing_ok=True)
+
+
+def sweep_api_cache():
+    """Delete cached responses older than the longest TTL (run once per run).
+
+    Every distinct query leaves its own file, and most are never asked for
+    again, so expiry on read alone would let the directory grow forever."""
+    if not API_CACHE_DIR.exists():
+        return
+    cutoff = time.time() - max(API_CACHE_TTL.values())
+    for path in API_CACHE_DIR.iterdir():  # .json entries and any .tmp a killed run left
+        try:
+            if path.stat().st_mtime < cutoff:
+                path.unlink()
+        except FileNotFoundError:
+            pass
+
+
 def api_match_count(alias, gateway=DEFAULT_GATEWAY):
     """Get total match count for a player (HEAD request with count=exact)."""
     url = f"{SUPABASE_URL}/rest/v1/player_matches"
@@ -108,9 +214,7 @@ def api_match_count(alias, gateway=DEFAULT_GATEWAY):
         "gateway": f"eq.{gateway}",
         "limit": 1,
     }
-    headers = get_headers()
-    headers["Prefer"] = "count=exact"
-    resp = requests.head(url, headers=headers, params=params)
+    resp = SESSION.head(url, headers=COUNT_HEADERS, params=params)
     resp.raise_for_status()
     cr = resp.headers.get("content-range", "")
     # content-range: 0-0/22 or */0
@@ -119,56 +223,122 @@ def api_match_count(alias, gateway=DEFAULT_GATEWAY):
     return 0
 
 
-def api_matches(alias, gateway=DEFAULT_GATEWAY, limit=PAGE_SIZE, offset=0):
-    """Fetch match history page for a player."""
+def api_match_count_since(alias, gateway=DEFAULT_GATEWAY, since=None, until=None):
+    """Get match count for a player in a date range (HEAD request, no body)."""
     url = f"{SUPABASE_URL}/rest/v1/player_matches"
-    params = {
-        "select": "*",
-        "gateway": f"eq.{gateway}",
-        "alias": f"eq.{alias}",
-        "order": "timestamp.desc",
-        "limit": limit,
-        "offset": offset,
-    }
-    resp = requests.get(url, headers=get_headers(), params=params)
+    params = [
+        ("alias", f"eq.{alias}"),
+        ("gateway", f"eq.{gateway}"),
+        ("limit", 1),
+    ]
+    if since:
+        params.append(("timestamp", f"gte.{since}"))
+    if until:
+        params.append(("timestamp", f"lte.{until}"))
+    resp = SESSION.head(url, headers=COUNT_HEADERS, params=params)
     resp.raise_for_status()
-    return resp.json()
+    cr = resp.headers.get("content-range", "")
+    if "/" in cr:
+        return int(cr.split("/")[1])
+    return 0
 
 
-def api_matches_all(alias, gateway=DEFAULT_GATEWAY, limit=DEFAULT_LIMIT):
+def api_matches(alias, gateway=DEFAULT_GATEWAY, limit=PAGE_SIZE, offset=0, select="*", filters=()):
+    """Fetch match history page for a player.
+
+    `filters` is a list of extra (column, "op.value") PostgREST params, e.g.
+    from match_filters() — applied server-side before limit/offset.
+    """
+    # List of tuples so a column can appear twice (e.g. duration gte + lte)
+    params = [
+        ("select", select),
+        ("gateway", f"eq.{gateway}"),
+        ("alias", f"eq.{alias}"),
+        ("order", "timestamp.desc"),
+        ("limit", limit),
+        ("offset", offset),
+    ]
+    params.extend(filters)
+    return api_get("player_matches", params)
+
+
+def like_escape(text):
+    """Escape LIKE wildcards (% and _) and the escape char itself for an ilike pattern."""
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def match_filters(matchup=None, opponent=None, min_sec=None, max_sec=None):
+    """Build PostgREST filter params for api_matches (all case-insensitive).
+
+    There is no map filter: the stored map names still carry BW color codes,
+    which can split a search term, so cmd_matches matches --map locally
+    against the cleaned display name."""
+    filters = []
+    # Server-side these only narrow the results (PostgREST still reads * as a
+    # wildcard); cmd_matches re-checks them exactly
+    if matchup:
+        filters.append(("matchup", f"ilike.{like_escape(matchup)}"))
+    if opponent:
+        filters.append(("opponent_alias", f"ilike.*{like_escape(opponent)}*"))
+    if min_sec is not None:
+        filters.append(("duration", f"gte.{min_sec}"))
+    if max_sec is not None:
+        filters.append(("duration", f"lte.{max_sec}"))
+    return filters
+
+
+def iter_match_pages(alias, gateway=DEFAULT_GATEWAY, limit=DEFAULT_LIMIT, filters=()):
+    """Yield pages of up to `limit` matches total.
+
+    The next page is requested in the background (after API_PAGE_DELAY) as soon
+    as the current one arrives, so the caller's work on page N overlaps the
+    delay + fetch of page N+1.
+    """
+    def fetch(offset, page_size, delay):
+        if delay:
+            time.sleep(API_PAGE_DELAY)
+        return api_matches(alias, gateway, limit=page_size, offset=offset, filters=filters)
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        fetched = 0
+        page_size = min(PAGE_SIZE, limit)
+        future = executor.submit(fetch, 0, page_size, False)
+        while True:
+            page = future.result()
+            if not page:
+                return
+            fetched += len(page)
+            next_size = min(PAGE_SIZE, limit - fetched)
+            more = len(page) >= page_size and next_size > 0
+            if more:
+                future = executor.submit(fetch, fetched, next_size, True)
+                page_size = next_size
+            yield page
+            if not more:
+                return
+
+
+def api_matches_all(alias, gateway=DEFAULT_GATEWAY, limit=DEFAULT_LIMIT, filters=()):
     """Fetch up to `limit` matches, auto-paginating."""
     results = []
-    offset = 0
-    while len(results) < limit:
-        page_size = min(PAGE_SIZE, limit - len(results))
-        page = api_matches(alias, gateway, limit=page_size, offset=offset)
-        if not page:
-            break
+    for page in iter_match_pages(alias, gateway, limit=limit, filters=filters):
         results.extend(page)
-        if len(page) < page_size:
-            break
-        offset += len(page)
-        time.sleep(API_PAGE_DELAY)
     return results[:limit]
 
 
 def api_rankings(gateway=DEFAULT_GATEWAY, limit=DEFAULT_LIMIT):
     """Fetch ladder rankings."""
-    url = f"{SUPABASE_URL}/rest/v1/rankings_view"
     params = {
         "select": "standing,rating,wins,losses,disconnects,avatar,race,rank,alias,gateway,gateway_name",
         "gateway": f"eq.{gateway}",
         "standing": f"lte.{limit}",
         "order": "standing.asc",
     }
-    resp = requests.get(url, headers=get_headers(), params=params)
-    resp.raise_for_status()
-    return resp.json()
+    return api_get("rankings_view", params)
 
 
 def api_search(query, gateway=DEFAULT_GATEWAY):
     """Search players by alias (ilike)."""
-    url = f"{SUPABASE_URL}/rest/v1/rankings_view"
     params = {
         "select": "standing,rating,wins,losses,race,rank,alias,gateway,gateway_name",
         "alias": f"ilike.*{query}*",
@@ -176,23 +346,18 @@ def api_search(query, gateway=DEFAULT_GATEWAY):
         "order": "standing.asc",
         "limit": 50,
     }
-    resp = requests.get(url, headers=get_headers(), params=params)
-    resp.raise_for_status()
-    return resp.json()
+    return api_get("rankings_view", params)
 
 
 def api_aurora_id(alias, gateway=DEFAULT_GATEWAY):
     """Look up aurora_id for a player alias from their match history."""
-    url = f"{SUPABASE_URL}/rest/v1/player_matches"
     params = {
         "select": "aurora_id",
         "alias": f"eq.{alias}",
         "gateway": f"eq.{gateway}",
         "limit": 1,
     }
-    resp = requests.get(url, headers=get_headers(), params=params)
-    resp.raise_for_status()
-    rows = resp.json()
+    rows = api_get("player_matches", params)
     if not rows:
         return None
     return rows[0]["aurora_id"]
@@ -200,25 +365,40 @@ def api_aurora_id(alias, gateway=DEFAULT_GATEWAY):
 
 def api_handles(battlenet_account):
     """Fetch all aliases linked to a battlenet_account ID."""
-    url = f"{SUPABASE_URL}/rest/v1/players"
     params = {
         "select": "standing,rating,wins,losses,race,rank,alias,gateway,battlenet_account",
         "battlenet_account": f"eq.{battlenet_account}",
         "order": "standing.asc",
     }
-    resp = requests.get(url, headers=get_headers(), params=params)
-    resp.raise_for_status()
-    return resp.json()
-
-
-def api_matches_since(alias, gateway=DEFAULT_GATEWAY, since=None, until=None):
-    """Fetch all matches for an alias since a given date. Auto-paginates."""
+    return api_get("players", params)
+
+
+def api_handles_bulk(battlenet_accounts):
+    """Fetch aliases for many battlenet_account IDs using batched IN-list queries.
+    Returns dict mapping battlenet_account -> list of handles (standing order)."""
+    accounts = list(dict.fromkeys(battlenet_accounts))
+    by_account = {a: [] for a in accounts}
+    for i in range(0, len(accounts), HANDLES_BATCH):
+        batch = accounts[i:i + HANDLES_BATCH]
+        params = {
+            "select": "standing,rating,wins,losses,race,rank,alias,gateway,battlenet_account",
+            "battlenet_account": f"in.({','.join(str(a) for a in batch)})",
+            "order": "standing.asc",
+        }
+        for h in api_get("players", params):
+            by_account.setdefault(h["battlenet_account"], []).append(h)
+    return by_account
+
+
+def api_matches_since(alias, gateway=DEFAULT_GATEWAY, since=None, until=None, select="*"):
+    """Fetch all matches for an alias since a given date. Auto-paginates.
+    Pass select=SCRAPE_SELECT when only the download fields are needed."""
     results = []
     offset = 0
     while True:
         # Use list of tuples to allow duplicate 'timestamp' params for range queries
         params = [
-            ("select", "*"),
+            ("select", select),
             ("gateway", f"eq.{gateway}"),
             ("alias", f"eq.{alias}"),
             ("order", "timestamp.desc"),
@@ -229,11 +409,7 @@ def api_matches_since(alias, gateway=DEFAULT_GATEWAY, since=None, until=None):
             params.append(("timestamp", f"gte.{since}"))
         if until:
             params.append(("timestamp", f"lte.{until}"))
-        resp = requests.get(
-            f"{SUPABASE_URL}/rest/v1/player_matches",
-            headers=get_headers(), params=params)
-        resp.raise_for_status()
-        page = resp.json()
+        page = api_get("player_matches", params)
         if not page:
             break
         results.extend(page)
@@ -253,13 +429,59 @@ def extract_replay_match_id(replay_url):
     return replay_url.split("/")[-1].replace(".rep", "")
 
 
-def download_matches(matches, output_dir, existing_match_ids=None, dry_run=False):
+def open_dedup_db():
+    """Open the replay DB for match_id dedup.
+
+    Dedup is answered by indexed lookups (find_existing_match_ids), so memory
+    stays constant as the DB grows. Make sure the index exists even if this
+    DB predates it — otherwise every lookup is a full table scan.
+    """
+    conn = sqlite3.connect(DB_PATH)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_replay_match_id ON replays(match_id)")
+    return conn
+
+
+def find_existing_match_ids(conn, match_ids):
+    """Return the subset of `match_ids` already in the DB.
+
+    Only the candidates are sent to SQLite (chunked IN-lists), so the
+    idx_replay_match_id index does the lookups instead of a full-table set.
+    """
+    found = set()
+    match_ids = list(match_ids)
+    for i in range(0, len(match_ids), SQL_IN_BATCH):
+        batch = match_ids[i:i + SQL_IN_BATCH]
+        placeholders = ",".join(["?"] * len(batch))
+        found.update(row[0] for row in conn.execute(
+            f"SELECT match_id FROM replays WHERE match_id IN ({placeholders})", batch))
+    return found
+
+
+def download_replay(replay_url, output_path):
+    """Stream one replay file to disk. Returns the HTTP status code."""
+    with SESSION.get(replay_url, stream=True) as resp:
+        if resp.status_code == 200:
+            # Stream socket -> file; write to .part so an interrupted
+            # download never looks like a finished replay
+            part_path = output_path[:-len(".rep")] + ".part"
+            resp.raw.decode_content = True
+            with open(part_path, "wb") as f:
+                shutil.copyfileobj(resp.raw, f, length=DOWNLOAD_CHUNK_SIZE)
+            os.replace(part_path, output_path)
+        return resp.status_code
+
+
+def download_matches(matches, output_dir, conn=None, seen_match_ids=None, dry_run=False):
     """Download replay files from a list of API match dicts.
 
+    Downloads run concurrently on DOWNLOAD_WORKERS threads; request starts are
+    still spaced DOWNLOAD_DELAY apart, so only the latency overlaps.
+
     Args:
         matches: list of match dicts from the cwal API
         output_dir: Path to download directory
-        existing_match_ids: set of MM-... match_ids already in DB (skip these)
+        conn: sqlite3 connection to dedup against match_ids already in the DB
+        seen_match_ids: set of match_ids already handled this run (skip these)
         dry_run: if True, only print what would be downloaded
 
     Returns:
@@ -269,19 +491,28 @@ def download_matches(matches, output_dir, existing_match_ids=None, dry_run=False
     if not downloadable:
         return 0, 0
 
+    # DB dedup: one indexed lookup per batch of candidates
+    seen_match_ids = seen_match_ids or set()
+    in_db = set()
+    if conn is not None:
+        in_db = find_existing_match_ids(
+            conn, {extract_replay_match_id(m["replay_url"]) for m in downloadable})
+
     if not dry_run:
         output_dir.mkdir(parents=True, exist_ok=True)
 
-    metadata_path = output_dir / "_metadata.jsonl"
+    # Plain strings in the loop — pathlib objects per file add up on big scrapes
+    out_dir_str = str(output_dir)
+    metadata_path = os.path.join(out_dir_str, "_metadata.jsonl")
     downloaded = 0
     skipped = 0
+    todo = []  # (match, filename, output_path)
 
     for m in downloadable:
-        replay_url = m["replay_url"]
-        match_id = extract_replay_match_id(replay_url)
+        match_id = extract_replay_match_id(m["replay_url"])
 
-        # DB dedup
-        if existing_match_ids and match_id in existing_match_ids:
+        # DB / in-run dedup
+        if match_id in in_db or match_id in seen_match_ids:
             skipped += 1
             continue
 
@@ -290,53 +521,72 @@ def download_matches(matches, output_dir, existing_match_ids=None, dry_run=False
         matchup = m.get("matchup", "unknown")
         result = m.get("result", "unknown")
         filename = f"{alias}_vs_{opponent}_{matchup}_{result}_{match_id}.rep"
-        output_path = output_dir / filename
-
-        if dry_run:
-            if output_path.exists():
-                skipped += 1
-            else:
-                downloaded += 1
-                print(f"  [GET] {filename}")
-            continue
+        output_path = os.path.join(out_dir_str, filename)
 
         # Filesystem dedup
-        if output_path.exists():
+        if os.path.exists(output_path):
             skipped += 1
             continue
 
-        resp = requests.get(replay_url)
-        if resp.status_code == 200:
-            output_path.write_bytes(resp.content)
+        if dry_run:
             downloaded += 1
-            print(f"  Downloaded: {filename}")
-
-            meta = {
-                "match_id": m.get("id"),
-                "file_name": filename,
-                "alias": alias,
-                "aurora_id": m.get("aurora_id"),
-                "opponent_alias": m.get("opponent_alias"),
-                "opponent_aurora_id": m.get("opponent_aurora_id"),
-                "gateway": m.get("gateway"),
-            }
-            with open(metadata_path, "a") as f:
-                f.write(json.dumps(meta) + "\n")
-        else:
-            print(f"  Failed ({resp.status_code}): {filename}")
-
-        time.sleep(DOWNLOAD_DELAY)
+            print(f"  [GET] {filename}")
+            continue
+
+        todo.append((m, filename, output_path))
+
+    if not todo:
+        return downloaded, skipped
+
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+        futures = {}
+        for i, (m, filename, output_path) in enumerate(todo):
+            if i > 0:
+                time.sleep(DOWNLOAD_DELAY)
+            futures[executor.submit(download_replay, m["replay_url"], output_path)] = (m, filename)
+
+            # Record finished downloads as we go so an interrupted run keeps its metadata
+            done = [f for f in futures if f.done()]
+            for future in done:
+                downloaded += record_download(future, *futures.pop(future), metadata_path)
+
+        for future in as_completed(futures):
+            downloaded += record_download(future, *futures[future], metadata_path)
 
     return downloaded, skipped
 
 
-def load_existing_match_ids():
-    """Load all match_ids from the DB for dedup."""
-    conn = sqlite3.connect(DB_PATH)
-    ids = {row[0] for row in conn.execute(
-        "SELECT match_id FROM replays WHERE match_id IS NOT NULL")}
-    conn.close()
-    return ids
+def record_download(future, m, filename, metadata_path):
+    """Report a finished download and append its _metadata.jsonl line.
+    Returns 1 if the replay was saved, else 0."""
+    try:
+        status = future.result()
+    except requests.exceptions.RequestException as e:
+        print(f"  Failed ({e.__class__.__name__}): {filename}")
+        return 0
+    if status != 200:
+        print(f"  Failed ({status}): {filename}")
+        return 0
+
+    print(f"  Downloaded: {filename}")
+    meta = {
+        "match_id": m.get("id"),
+        "file_name": filename,
+        "alias": m.get("alias", "unknown"),
+        "aurora_id": m.get("aurora_id"),
+        "opponent_alias": m.get("opponent_alias"),
+        "opponent_aurora_id": m.get("opponent_aurora_id"),
+        "gateway": m.get("gateway"),
+    }
+    with open(metadata_path, "a") as f:
+        f.write(json_dumps(meta) + "\n")
+    return 1
+
+
+def count_existing_match_ids(conn):
+    """Count replays in the DB that carry a match_id."""
+    return conn.execute(
+        "SELECT COUNT(*) FROM replays WHERE match_id IS NOT NULL").fetchone()[0]
 
 
 def append_ledger(command, players, new, skipped, notes=""):
@@ -359,71 +609,86 @@ def append_ledger(command, players, new, skipped, notes=""):
 
 def cmd_matches(args):
     """Search a player's match history with optional filters."""
+    # Matchup / opponent / duration filters run server-side, so --limit counts
+    # games matching those; --map is only checked locally (see match_filters)
+    min_sec = parse_duration(args.min_duration) if args.min_duration else None
+    max_sec = parse_duration(args.max_duration) if args.max_duration else None
+    filters = match_filters(args.matchup, args.opponent, min_sec, max_sec)
+
     print(f"Fetching matches for {args.alias} (gateway={args.gateway})...")
-    matches = api_matches_all(args.alias, gateway=args.gateway, limit=args.limit)
+    matches = api_matches_all(args.alias, gateway=args.gateway, limit=args.limit, filters=filters)
 
     if not matches:
         print("No matches found.")
         return
 
-    # Client-side filters
-    filtered = matches
-    if args.map:
-        map_lower = args.map.lower()
-        filtered = [m for m in filtered if map_lower in get_map_display(m).lower()]
-    if args.matchup:
-        mu = args.matchup.lower()
-        filtered = [m for m in filtered if (m.get("matchup") or "").lower() == mu]
-    if args.opponent:
-        opp_lower = args.opponent.lower()
-        filtered = [m for m in filtered if opp_lower in (m.get("opponent_alias") or "").lower()]
-    if args.min_duration:
-        min_sec = parse_duration(args.min_duration)
-        filtered = [m for m in filtered if (m.get("duration") or 0) >= min_sec]
-    if args.max_duration:
-        max_sec = parse_duration(args.max_duration)
-        filtered = [m for m in filtered if (m.get("duration") or 9999999) <= max_sec]
+    # Map display is needed by the table and is what --map matches against.
+    # --matchup / --opponent get the same exact checks as before the server filters
+    map_lower = args.map.lower() if args.map else None
+    mu = args.matchup.lower() if args.matchup else None
+    opp_lower = args.opponent.lower() if args.opponent else None
+    filtered = []
+    for m in matches:
+        m["_map_display"] = get_map_display(m)
+        if map_lower is not None and map_lower not in m["_map_display"].lower():
+            continue
+        if mu is not None and (m.get("matchup") or "").lower() != mu:
+            continue
+        if opp_lower is not None and opp_lower not in (m.get("opponent_alias") or "").lower():
+            continue
+        filtered.append(m)
 
     if not filtered:
         print(f"No matches after filtering ({len(matches)} total fetched).")
         return
 
-    # Print table
+    # Print table (rows buffered into a single write)
     print(f"\n{len(filtered)} matches (of {len(matches)} fetched):\n")
+    if len(filtered) < len(matches) == args.limit:
+        print(f"(local re-check hid {len(matches) - len(filtered)} of the {args.limit} fetched; "
+              f"raise --limit to see more)\n")
     header = f"{'Date':<12} {'Map':<20} {'Duration':>8} {'Matchup':<6} {'Opponent':<20} {'Result':<7} {'MMR':>5}"
-    print(header)
-    print("—" * len(header))
+    lines = [header, "—" * len(header)]
     for m in filtered:
         date = format_date(m.get("timestamp"))
-        map_name = get_map_display(m)[:20]
+        map_name = m["_map_display"][:20]
         dur = format_duration(m.get("duration"))
         matchup = m.get("matchup") or "—"
         opponent = (m.get("opponent_alias") or "—")[:20]
         result = m.get("result") or "—"
         mmr = m.get("mmr")
         mmr_str = str(mmr) if mmr is not None else "—"
-        print(f"{date:<12} {map_name:<20} {dur:>8} {matchup:<6} {opponent:<20} {result:<7} {mmr_str:>5}")
+        lines.append(f"{date:<12} {map_name:<20} {dur:>8} {matchup:<6} {opponent:<20} {result:<7} {mmr_str:>5}")
+    write_lines(lines)
 
 
 def cmd_scrape(args):
     """Download replays for a player."""
     print(f"Fetching matches for {args.alias} (gateway={args.gateway})...")
-    matches = api_matches_all(args.alias, gateway=args.gateway, limit=args.limit)
+    output_dir = Path(args.output)
+    total = 0
+    with_replays = 0
+    downloaded = 0
+    skipped = 0
 
-    if not matches:
+    # Download page by page — the next API page is prefetched meanwhile
+    for page in iter_match_pages(args.alias, gateway=args.gateway, limit=args.limit):
+        total += len(page)
+        with_replays += sum(1 for m in page if m.get("replay_url"))
+        page_downloaded, page_skipped = download_matches(
+            page, output_dir, dry_run=args.dry_run)
+        downloaded += page_downloaded
+        skipped += page_skipped
+
+    if not total:
         print("No matches found.")
         return
 
-    downloadable = [m for m in matches if m.get("replay_url")]
-    print(f"Found {len(downloadable)} matches with replays (of {len(matches)} total).")
+    print(f"Found {with_replays} matches with replays (of {total} total).")
 
-    if not downloadable:
+    if not with_replays:
         return
 
-    output_dir = Path(args.output)
-    downloaded, skipped = download_matches(
-        matches, output_dir, dry_run=args.dry_run)
-
     if args.dry_run:
         print(f"\nDry run — would download to {output_dir}/")
     else:
@@ -445,8 +710,7 @@ def cmd_rankings(args):
 
     print()
     header = f"{'#':>4} {'Alias':<22} {'Race':<10} {'Rating':>6} {'W-L':<10} {'Gateway'}"
-    print(header)
-    print("—" * len(header))
+    lines = [header, "—" * len(header)]
     for p in players:
         standing = p.get("standing", "—")
         alias = (p.get("alias") or "—")[:22]
@@ -456,7 +720,8 @@ def cmd_rankings(args):
         losses = p.get("losses", 0)
         wl = f"{wins}-{losses}"
         gw_name = p.get("gateway_name") or str(p.get("gateway", "—"))
-        print(f"{standing:>4} {alias:<22} {race:<10} {rating:>6} {wl:<10} {gw_name}")
+        lines.append(f"{standing:>4} {alias:<22} {race:<10} {rating:>6} {wl:<10} {gw_name}")
+    write_lines(lines)
 
 
 def cmd_search(args):
@@ -470,8 +735,7 @@ def cmd_search(args):
 
     print(f"\n{len(players)} result(s):\n")
     header = f"{'#':>4} {'Alias':<22} {'Race':<10} {'Rating':>6} {'W-L':<10} {'Gateway'}"
-    print(header)
-    print("—" * len(header))
+    lines = [header, "—" * len(header)]
     for p in players:
         standing = p.get("standing", "—")
         alias = (p.get("alias") or "—")[:22]
@@ -481,7 +745,8 @@ def cmd_search(args):
         losses = p.get("losses", 0)
         wl = f"{wins}-{losses}"
         gw_name = p.get("gateway_name") or str(p.get("gateway", "—"))
-        print(f"{standing:>4} {alias:<22} {race:<10} {rating:>6} {wl:<10} {gw_name}")
+        lines.append(f"{standing:>4} {alias:<22} {race:<10} {rating:>6} {wl:<10} {gw_name}")
+    write_lines(lines)
 
 
 def cmd_handles(args):
@@ -512,8 +777,7 @@ def cmd_handles(args):
 
     print(f"\n{len(handles)} handle(s):\n")
     header = f"{'#':>4} {'Alias':<22} {'Race':<10} {'Rating':>6} {'W-L':<10} {'Gateway':>10}"
-    print(header)
-    print("—" * len(header))
+    lines = [header, "—" * len(header)]
     for p in handles:
         standing = p.get("standing", "—")
         alias = (p.get("alias") or "—")[:22]
@@ -524,7 +788,8 @@ def cmd_handles(args):
         wl = f"{wins}-{losses}"
         gw = p.get("gateway", 0)
         gw_name = GATEWAY_NAMES.get(gw, str(gw))
-        print(f"{standing:>4} {alias:<22} {race:<10} {rating:>6} {wl:<10} {gw_name:>10}")
+        lines.append(f"{standing:>4} {alias:<22} {race:<10} {rating:>6} {wl:<10} {gw_name:>10}")
+    write_lines(lines)
 
 
 def cmd_count(args):
@@ -544,22 +809,23 @@ def cmd_refresh(args):
     since = args.since or (datetime.now() - timedelta(days=7)).strftime("%Y-%m-%d")
     print(f"Refreshing labeled players (games since {since})...")
 
-    existing = load_existing_match_ids()
-    print(f"DB has {len(existing)} existing replays")
+    conn = open_dedup_db()
+    print(f"DB has {count_existing_match_ids(conn)} existing replays")
+    seen = set()  # match_ids handled this run (not yet ingested into the DB)
 
-    conn = sqlite3.connect(DB_PATH)
     identities = conn.execute(
         "SELECT canonical_name, aurora_id FROM player_identities ORDER BY canonical_name"
     ).fetchall()
-    conn.close()
     print(f"Found {len(identities)} labeled players\n")
 
     output_dir = Path(args.output)
     total_new = 0
     total_skipped = 0
 
+    handles_by_account = api_handles_bulk(aurora_id for _, aurora_id in identities)
+
     for canonical, aurora_id in identities:
-        handles = api_handles(aurora_id)
+        handles = handles_by_account.get(aurora_id)
         if not handles:
             print(f"  {canonical}: no handles found (aurora_id={aurora_id})")
             continue
@@ -574,7 +840,11 @@ def cmd_refresh(args):
                 continue
 
             try:
-                matches = api_matches_since(alias, gateway=gw, since=since)
+                # Cheap HEAD count first — most handles have no new games
+                if api_match_count_since(alias, gateway=gw, since=since) == 0:
+                    continue
+                matches = api_matches_since(alias, gateway=gw, since=since,
+                                            select=SCRAPE_SELECT)
             except requests.exceptions.HTTPError as e:
                 print(f"  {canonical}: API error for {alias}@{GATEWAY_NAMES.get(gw, str(gw))}: {e}")
                 continue
@@ -583,7 +853,7 @@ def cmd_refresh(args):
                 continue
 
             downloaded, skipped = download_matches(
-                matches, output_dir, existing_match_ids=existing,
+                matches, output_dir, conn=conn, seen_match_ids=seen,
                 dry_run=args.dry_run)
 
             if downloaded > 0:
@@ -596,12 +866,13 @@ def cmd_refresh(args):
             for m in matches:
                 url = m.get("replay_url")
                 if url:
-                    existing.add(extract_replay_match_id(url))
+                    seen.add(extract_replay_match_id(url))
 
         if player_new > 0:
             print(f"  {canonical}: {player_new} new ({', '.join(handle_strs)})")
         total_new += player_new
 
+    conn.close()
     print(f"\nRefresh complete: {total_new} new, {total_skipped} skipped")
 
     if not args.dry_run and total_new > 0:
@@ -619,34 +890,41 @@ def cmd_scrape_date(args):
     date_desc = f"since {since}" + (f", until {until}" if until else "")
     print(f"Scraping replays from top {top} ranked players ({date_desc})...")
 
-    existing = load_existing_match_ids()
-    print(f"DB has {len(existing)} existing replays")
+    conn = open_dedup_db()
+    print(f"DB has {count_existing_match_ids(conn)} existing replays")
 
     # Fetch ranked players across all major gateways
     all_players = []
     seen_aliases = set()
-    for gw in [30, 10, 20, 45]:
+    for gw in SCRAPE_GATEWAYS:
         try:
             ranked = api_rankings(gateway=gw, limit=top)
         except requests.exceptions.HTTPError:
             continue
         for p in ranked:
-            alias = p.get("alias")
-            key = (alias, gw)
+            key = (p.get("alias"), gw)
             if key not in seen_aliases:
                 seen_aliases.add(key)
-                all_players.append((alias, gw))
+                all_players.append(key)
 
     print(f"Found {len(all_players)} ranked players across gateways\n")
 
+    # One process, one pass over every gateway: the dedup sets are shared (a
+    # cross-gateway match shows up under both players) and download_matches
+    # keeps the single DOWNLOAD_DELAY spacing and _metadata.jsonl writer
     output_dir = Path(args.output)
     total_new = 0
     total_skipped = 0
+    seen = set()  # match_ids handled this run (not yet ingested into the DB)
     seen_urls = set()  # Deduplicate across players (same match appears for both)
 
     for i, (alias, gw) in enumerate(all_players):
         try:
-            matches = api_matches_since(alias, gateway=gw, since=since, until=until)
+            # Straight to the GET: top ranked players nearly always have games in
+            # range, so a HEAD count first would just add a round trip (an empty
+            # range costs one GET either way)
+            matches = api_matches_since(alias, gateway=gw, since=since, until=until,
+                                        select=SCRAPE_SELECT)
         except requests.exceptions.HTTPError as e:
             # Barcode names often 500 — skip silently
             continue
@@ -666,7 +944,7 @@ def cmd_scrape_date(args):
             continue
 
         downloaded, skipped = download_matches(
-            unique_matches, output_dir, existing_match_ids=existing,
+            unique_matches, output_dir, conn=conn, seen_match_ids=seen,
             dry_run=args.dry_run)
 
         if downloaded > 0:
@@ -675,11 +953,13 @@ def cmd_scrape_date(args):
         total_new += downloaded
         total_skipped += skipped
 
-        # Update existing set
+        # Track handled match_ids
         for m in unique_matches:
             url = m.get("replay_url")
             if url:
-                existing.add(extract_replay_match_id(url))
+                seen.add(extract_replay_match_id(url))
+
+    conn.close()
 
     date_range = since + (f" to {until}" if until else "+")
     print(f"\nScrape-date complete: {total_new} new, {total_skipped} skipped ({date_range})")
@@ -700,17 +980,19 @@ def main():
         prog="cwal",
         description="cwal.gg ladder API tool for Barcode Reader",
     )
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Clear the on-disk API response cache before running")
     sub = parser.add_subparsers(dest="command", required=True)
 
     # -- matches --
     p_matches = sub.add_parser("matches", help="Search a player's match history")
     p_matches.add_argument("alias", help="Player alias (exact match)")
-    p_matches.add_argument("--map", help="Filter by map name (substring)")
+    p_matches.add_argument("--map", help="Filter by map name (substring, checked locally after --limit)")
     p_matches.add_argument("--matchup", help="Filter by matchup (e.g. pvt, zvz)")
     p_matches.add_argument("--opponent", help="Filter by opponent name (substring)")
     p_matches.add_argument("--min-duration", metavar="MM:SS", help="Minimum game duration")
     p_matches.add_argument("--max-duration", metavar="MM:SS", help="Maximum game duration")
-    p_matches.add_argument("--limit", type=int, default=DEFAULT_LIMIT, help=f"Max matches to fetch (default {DEFAULT_LIMIT})")
+    p_matches.add_argument("--limit", type=int, default=DEFAULT_LIMIT, help=f"Max matching games to fetch (default {DEFAULT_LIMIT})")
     p_matches.add_argument("--gateway", type=int, default=DEFAULT_GATEWAY, help=f"Gateway ID (default {DEFAULT_GATEWAY}=Korea)")
     p_matches.set_defaults(func=cmd_matches)
 
@@ -764,6 +1046,10 @@ def main():
     p_scrape_date.set_defaults(func=cmd_scrape_date)
 
     args = parser.parse_args()
+    if args.no_cache:
+        clear_api_cache()
+    else:
+        sweep_api_cache()
     args.func(args)
 
 
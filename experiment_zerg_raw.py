@@ -11,129 +11,264 @@ Usage:
 """
 
 import argparse
-import copy
-import sqlite3
 import sys
-from collections import Counter
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
+import joblib
 import numpy as np
-from sklearn.ensemble import RandomForestClassifier
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy.sparse import csr_matrix
+from sklearn.ensemble import HistGradientBoostingClassifier, RandomForestClassifier
+from sklearn.inspection import permutation_importance
 from sklearn.model_selection import LeaveOneOut, cross_val_predict
 from sklearn.preprocessing import StandardScaler
 
 from features import (
-    DB_PATH, GLOBAL_NGRAM_TOP_N,
+    DB_PATH, GLOBAL_NGRAM_TOP_N, open_db,
     parse_replay, trim_at_leave, extract_features,
     get_pro_identities, get_player_replays_by_aurora,
-    select_global_ngrams, apply_ngram_features, create_feature_matrix,
+    create_feature_matrix,
 )
 
 MIN_DATE = "2025-01-01"
 
+# Persistent per-replay sample cache (see process_replay_dual)
+FEATURE_CACHE = joblib.Memory(DB_PATH.parent / "cache" / "features", verbose=0)
+FEATURE_VERSION = 3  # 3: drop samples cached as [] by failed parses
+
 # Non-gameplay commands to exclude from raw n-grams
 IGNORED_CMDS = {"Chat", "Leave Game", "Alliance", "Vision"}
 
 
-def extract_raw_ngrams(commands, n):
-    """Extract n-grams using raw command type names (no abstraction, no Prod collapse)."""
-    types = [c["Type"]["Name"] for c in commands if c["Type"]["Name"] not in IGNORED_CMDS]
-    ngrams = Counter()
-    for i in range(len(types) - n + 1):
-        gram = "_".join(types[i:i + n])
-        ngrams[gram] += 1
-    return ngrams
+# Raw command name <-> small int code, grown as new names appear (per process)
+CMD_CODES = {}
+CMD_NAMES = []
 
 
-def extract_samples_dual(conn, aurora_ids, label, min_date=None):
-    """Extract samples with both abstracted and raw n-grams stored per sample."""
-    replays = get_player_replays_by_aurora(conn, aurora_ids, min_date=min_date)
+def encode_cmd_names(names):
+    """Map command type names to an int64 array of CMD_CODES."""
+    for name in set(names).difference(CMD_CODES):
+        CMD_CODES[name] = len(CMD_NAMES)
+        CMD_NAMES.append(name)
+    return np.fromiter(map(CMD_CODES.__getitem__, names), dtype=np.int64, count=len(names))
+
+
+def encode_raw_types(commands):
+    """Encode a player's gameplay command type names (IGNORED_CMDS dropped) as
+    CMD_CODES. Done once per sample and shared by every n-gram size."""
+    return encode_cmd_names([
+        name for name in (c["Type"]["Name"] for c in commands) if name not in IGNORED_CMDS])
+
+
+def extract_raw_ngrams(codes, n):
+    """Extract n-grams using raw command type names (no abstraction, no Prod collapse).
+
+    `codes` comes from encode_raw_types. Grams are counted as integer keys in
+    NumPy (exact base-len(CMD_NAMES) encoding, no hashing collisions); only the
+    distinct grams are joined back into "A_B_C" strings, in first-occurrence
+    order like the string loop did.
+    """
+    if len(codes) < n:
+        return Counter()
+
+    windows = sliding_window_view(codes, n)
+    keys = windows @ (len(CMD_NAMES) ** np.arange(n - 1, -1, -1, dtype=np.int64))
+    _, first_idx, counts = np.unique(keys, return_index=True, return_counts=True)
+    order = np.argsort(first_idx)
+    grams = windows[first_idx[order]].tolist()
+    return Counter({
+        "_".join([CMD_NAMES[c] for c in gram]): count
+        for gram, count in zip(grams, counts[order].tolist())
+    })
+
+
+def process_replay_dual(file_path, replay_id, player_name, label, feature_version=FEATURE_VERSION):
+    """Parse one replay and extract dual n-gram samples for `player_name`.
+    Runs in a worker process. Returns a (possibly empty) list of sample dicts.
+
+    Called through cached_process_replay_dual, which caches results on disk
+    by arguments so reruns skip parsing entirely. `feature_version` is only
+    part of the cache key — bump FEATURE_VERSION whenever extract_features or
+    extract_raw_ngrams output changes.
+
+    Parse failures raise, so they are never cached (see try_process_replay_dual).
+    """
+    path = Path(file_path)
     samples = []
+    data = parse_replay(path)
+    all_cmds = data.get("Commands", {}).get("Cmds", [])
+    game_frames = data["Header"]["Frames"]
 
-    for file_path, replay_id, player_name in replays:
-        path = Path(file_path)
-        if not path.exists():
+    # Bucket commands by player in one pass
+    cmds_by_player = defaultdict(list)
+    for c in all_cmds:
+        cmds_by_player[c["PlayerID"]].append(c)
+
+    for player in data["Header"]["Players"]:
+        if player["Type"]["Name"] != "Human":
+            continue
+        if player["Name"] != player_name:
             continue
 
-        try:
-            data = parse_replay(path)
-            all_cmds = data.get("Commands", {}).get("Cmds", [])
-            game_frames = data["Header"]["Frames"]
-
-            for player in data["Header"]["Players"]:
-                if player["Type"]["Name"] != "Human":
-                    continue
-                if player["Name"] != player_name:
-                    continue
-
-                player_cmds = [c for c in all_cmds if c["PlayerID"] == player["ID"]]
-                player_cmds, effective_frames = trim_at_leave(player_cmds, all_cmds, game_frames)
-
-                # Standard extraction (includes abstracted n-grams in raw_ngrams)
-                features, raw_ngrams = extract_features(player_cmds, effective_frames)
-
-                if features:
-                    # Also extract raw n-grams and store under rng2/rng3/rng4
-                    for n in [2, 3, 4]:
-                        ngrams = extract_raw_ngrams(player_cmds, n)
-                        total_ng = sum(ngrams.values())
-                        if total_ng > 0:
-                            raw_ngrams[f"rng{n}"] = (ngrams, total_ng)
-
-                    samples.append({
-                        "features": features,
-                        "raw_ngrams": raw_ngrams,
-                        "label": label,
-                        "alias": player_name,
-                        "race": player["Race"]["Name"],
-                        "replay_id": replay_id,
-                        "file": path.name,
-                    })
-        except Exception:
-            pass
+        player_cmds = cmds_by_player.get(player["ID"], [])
+        player_cmds, effective_frames = trim_at_leave(player_cmds, all_cmds, game_frames)
+
+        # Standard extraction (includes abstracted n-grams in raw_ngrams)
+        features, raw_ngrams = extract_features(player_cmds, effective_frames)
+
+        if features:
+            # Also extract raw n-grams and store under rng2/rng3/rng4
+            codes = encode_raw_types(player_cmds)
+            for n in [2, 3, 4]:
+                ngrams = extract_raw_ngrams(codes, n)
+                total_ng = sum(ngrams.values())
+                if total_ng > 0:
+                    raw_ngrams[f"rng{n}"] = (ngrams, total_ng)
+
+            samples.append({
+                "features": features,
+                "raw_ngrams": raw_ngrams,
+                "label": label,
+                "alias": player_name,
+                "race": player["Race"]["Name"],
+                "replay_id": replay_id,
+                "file": path.name,
+            })
 
     return samples
 
 
-def run_loo_cv(samples, ngram_prefixes, label):
-    """Run LOO CV on samples using the specified n-gram prefix keys. Returns results dict."""
-    samples = copy.deepcopy(samples)
+cached_process_replay_dual = FEATURE_CACHE.cache(process_replay_dual)
+
 
+def try_process_replay_dual(*args):
+    """cached_process_replay_dual, but a replay that fails to parse is
+    skipped (returns []) for this run only, instead of raising or being cached."""
+    try:
+        return cached_process_replay_dual(*args)
+    except Exception:
+        return []
+
+
+def extract_samples_dual(conn, aurora_ids, label, min_date=None, workers=None):
+    """Extract samples with both abstracted and raw n-grams stored per sample.
+    Replays are parsed in parallel across `workers` processes (default: all cores)."""
+    replays = get_player_replays_by_aurora(conn, aurora_ids, min_date=min_date)
+    if not replays:
+        return []
+
+    # Missing files are skipped up front so they never land in the cache
+    replays = [r for r in replays if Path(r[0]).exists()]
+    if not replays:
+        return []
+
+    file_paths, replay_ids, player_names = zip(*replays)
+    samples = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for replay_samples in executor.map(
+                try_process_replay_dual, file_paths, replay_ids, player_names,
+                [label] * len(replays), chunksize=8):
+            samples.extend(replay_samples)
+
+    return samples
+
+
+def build_ngram_matrix(all_raw_ngrams, prefixes):
+    """Two-pass n-gram selection + projection via sparse (sample x gram) matrices.
+
+    Equivalent to select_global_ngrams + apply_ngram_features on the given
+    prefixes, without per-sample dict lookups: counts go into one CSR matrix
+    per prefix, top-N comes from its column sums (ties keep first-seen order,
+    like Counter.most_common), and the selected columns are densified once.
+
+    Returns (X_ngram, ngram_names, global_ngrams).
+    """
+    per_prefix = {}  # prefix -> (gram_ids, rows, cols, counts, freqs)
+    for row, sample_ngrams in enumerate(all_raw_ngrams):
+        for prefix, (counter, total) in sample_ngrams.items():
+            if prefix not in prefixes:
+                continue
+            gram_ids, rows, cols, counts, freqs = per_prefix.setdefault(
+                prefix, ({}, [], [], [], []))
+            for gram, count in counter.items():
+                rows.append(row)
+                cols.append(gram_ids.setdefault(gram, len(gram_ids)))
+                counts.append(count)
+                freqs.append(count / total if total > 0 else 0)
+
+    n_samples = len(all_raw_ngrams)
+    blocks = []
+    ngram_names = []
+    global_ngrams = {}
+    for prefix, (gram_ids, rows, cols, counts, freqs) in per_prefix.items():
+        shape = (n_samples, len(gram_ids))
+        col_sums = np.asarray(csr_matrix((counts, (rows, cols)), shape=shape).sum(axis=0)).ravel()
+        top_n = GLOBAL_NGRAM_TOP_N.get(prefix, 10)
+        top = np.argsort(-col_sums, kind="stable")[:top_n]
+
+        grams = list(gram_ids)
+        global_ngrams[prefix] = [grams[i] for i in top]
+        ngram_names.extend(f"{prefix}_{grams[i]}" for i in top)
+        blocks.append(csr_matrix((freqs, (rows, cols)), shape=shape, dtype=np.float32)[:, top].toarray())
+
+    X_ngram = np.hstack(blocks) if blocks else np.zeros((n_samples, 0), dtype=np.float32)
+    return X_ngram, ngram_names, global_ngrams
+
+
+def make_classifier(model):
+    """Classifier for one LOO fold ("rf" or "hgb").
+
+    The forest is n_jobs=1; HistGradientBoosting uses OpenMP threads, which
+    run_loo_cv caps at one per fold worker."""
+    if model == "hgb":
+        # Histogram-binned boosting: much faster fits than the forest on this shape
+        return HistGradientBoostingClassifier(max_iter=200, max_depth=10, learning_rate=0.1,
+                                              random_state=42, class_weight="balanced")
+    return RandomForestClassifier(n_estimators=200, max_depth=10, random_state=42,
+                                  class_weight="balanced", n_jobs=1)
+
+
+def run_loo_cv(samples, X_numeric, y, numeric_names, ngram_prefixes, label, model="rf"):
+    """Run LOO CV on samples using the specified n-gram prefix keys. Returns results dict.
+
+    X_numeric / y / numeric_names are the standardized non-n-gram columns from
+    create_feature_matrix — identical across runs, so main() builds them once.
+    """
     # Filter raw_ngrams to only the requested prefixes (+ always include hotkey n-grams)
     hotkey_prefixes = {"hkg2", "hkg3", "ehkg2", "ehkg3"}
     active_prefixes = set(ngram_prefixes) | hotkey_prefixes
 
-    filtered_ngrams = []
-    for s in samples:
-        filtered = {k: v for k, v in s["raw_ngrams"].items() if k in active_prefixes}
-        filtered_ngrams.append(filtered)
-
-    # Two-pass global n-gram selection
-    global_ngrams = select_global_ngrams(filtered_ngrams)
+    # Two-pass global n-gram selection on sparse count matrices
+    X_ngram, ngram_names, global_ngrams = build_ngram_matrix(
+        [s["raw_ngrams"] for s in samples], active_prefixes)
 
-    # Apply n-gram features
-    for s, fn in zip(samples, filtered_ngrams):
-        apply_ngram_features(s["features"], fn, global_ngrams)
-
-    # Build feature matrix
-    X, y, feature_names = create_feature_matrix(samples)
+    # Scaling is per column, so only this run's n-gram block needs fitting;
+    # then join in the usual sorted-name column order
+    X_ngram = StandardScaler().fit_transform(X_ngram)
+    names = numeric_names + ngram_names
+    order = sorted(range(len(names)), key=names.__getitem__)
+    X_scaled = np.hstack([X_numeric, X_ngram])[:, order]
+    feature_names = [names[i] for i in order]
 
     ngram_count = sum(len(v) for v in global_ngrams.values())
     print(f"\n{'=' * 70}")
     print(f"RUN {label}")
     print(f"{'=' * 70}")
     print(f"  N-gram features: {ngram_count} (from {sorted(global_ngrams.keys())})")
-    print(f"  Total features: {X.shape[1]}")
+    print(f"  Total features: {X_scaled.shape[1]}")
     sys.stdout.flush()
 
     # LOO CV
-    scaler = StandardScaler()
-    X_scaled = scaler.fit_transform(X)
-
-    clf = RandomForestClassifier(n_estimators=200, max_depth=10, random_state=42,
-                                 class_weight="balanced", n_jobs=-1)
+    # Parallelize across folds (one single-threaded model per worker) rather
+    # than inside each model — LOO training sets are small, so inner
+    # threading mostly contends for cores. inner_max_num_threads pins the
+    # workers' OpenMP/BLAS pools (HGB) to one thread explicitly
+    clf = make_classifier(model)
     loo = LeaveOneOut()
-    predictions = cross_val_predict(clf, X_scaled, y, cv=loo)
+    with joblib.parallel_backend("loky", inner_max_num_threads=1):
+        predictions = cross_val_predict(clf, X_scaled, y, cv=loo, n_jobs=-1)
 
     correct = sum(1 for p, a in zip(predictions, y) if p == a)
     accuracy = correct / len(y)
@@ -165,8 +300,15 @@ def run_loo_cv(samples, ngram_prefixes, label):
             print(f"    {s['alias']:<25} → {pred:<15} (true: {s['label']}) [{s['file']}]")
 
     # Train final model for feature importances
-    clf.fit(X_scaled, y)
-    importances = clf.feature_importances_
+    if model == "hgb":
+        clf.fit(X_scaled, y)
+        # Boosting has no impurity importances — use permutation importance
+        importances = permutation_importance(
+            clf, X_scaled, y, n_repeats=5, random_state=42, n_jobs=-1).importances_mean
+    else:
+        clf.set_params(n_jobs=-1)
+        clf.fit(X_scaled, y)
+        importances = clf.feature_importances_
     top_idx = np.argsort(importances)[::-1][:15]
     print(f"\n  Top 15 features:")
     for i in top_idx:
@@ -176,7 +318,7 @@ def run_loo_cv(samples, ngram_prefixes, label):
         "accuracy": accuracy,
         "correct": correct,
         "total": len(y),
-        "features": X.shape[1],
+        "features": X_scaled.shape[1],
         "ngram_count": ngram_count,
         "player_results": player_results,
         "misclassified_count": len(misclassified),
@@ -189,13 +331,17 @@ def main():
                         help="Max Zerg games per player (default: unlimited)")
     parser.add_argument("--min-games", type=int, default=100,
                         help="Minimum Zerg games to include a player (default: 100)")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Replay parsing processes (default: all cores)")
+    parser.add_argument("--model", choices=["rf", "hgb"], default="rf",
+                        help="Classifier: rf = RandomForest, hgb = HistGradientBoosting (default: rf)")
     args = parser.parse_args()
 
     print("=" * 70)
     print("EXPERIMENT 16: ZERG-ONLY RAW N-GRAM ABLATION STUDY")
     print("=" * 70)
 
-    conn = sqlite3.connect(DB_PATH)
+    conn = open_db(DB_PATH)
     pros = get_pro_identities(conn, min_games=20)
 
     # Extract samples with dual n-grams
@@ -205,7 +351,7 @@ def main():
 
     for canonical, aurora_ids, total in pros:
         player_samples = extract_samples_dual(
-            conn, aurora_ids, label=canonical, min_date=MIN_DATE)
+            conn, aurora_ids, label=canonical, min_date=MIN_DATE, workers=args.workers)
 
         # Keep only Zerg games
         zerg_games = [s for s in player_samples if s["race"] == "Zerg"]
@@ -228,11 +374,17 @@ def main():
     players = sorted(set(s["label"] for s in all_samples))
     print(f"Players: {len(players)} ({', '.join(players)})")
 
+    # Numeric (non-n-gram) columns are shared by both runs — build + scale once
+    X_numeric, y, numeric_names = create_feature_matrix(all_samples)
+    X_numeric = StandardScaler().fit_transform(X_numeric)
+
     # Run A: Abstracted n-grams (baseline)
-    result_a = run_loo_cv(all_samples, ["ng2", "ng3", "ng4"], "A: ABSTRACTED N-GRAMS (baseline)")
+    result_a = run_loo_cv(all_samples, X_numeric, y, numeric_names, ["ng2", "ng3", "ng4"],
+                          "A: ABSTRACTED N-GRAMS (baseline)", model=args.model)
 
     # Run B: Raw n-grams (same budget)
-    result_b = run_loo_cv(all_samples, ["rng2", "rng3", "rng4"], "B: RAW N-GRAMS (experimental)")
+    result_b = run_loo_cv(all_samples, X_numeric, y, numeric_names, ["rng2", "rng3", "rng4"],
+                          "B: RAW N-GRAMS (experimental)", model=args.model)
 
     # Comparison table
     print(f"\n{'=' * 70}")
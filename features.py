@@ -3,21 +3,41 @@
 Shared feature extraction for StarCraft: Brood War player fingerprinting.
 """
 
+import hashlib
 import json
+import os
 import subprocess
+import sys
 import sqlite3
+import tempfile
+import threading
 from pathlib import Path
 from collections import Counter, defaultdict
-import statistics
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import joblib
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+try:
+    import orjson  # optional: much faster decode of large screp output
+except ImportError:
+    orjson = None
 
 SCREP_PATH = Path.home() / "go/bin/screp"
+SCREP_TIMEOUT = 60  # seconds before a hung screp is killed
+PARSE_CACHE_VERSION = 2  # bump whenever command_columns output changes
 DB_PATH = Path(__file__).parent / "data" / "replays.db"
 FRAME_MS = 42
 FRAMES_PER_MINUTE = (1000 / FRAME_MS) * 60
 MIN_GAME_MINUTES = 4
 MIN_COMMANDS = 100
 
+# Persistent per-replay sample cache (see process_replay)
+FEATURE_CACHE = joblib.Memory(DB_PATH.parent / "cache" / "features", verbose=0)
+PARSE_CACHE_DIR = DB_PATH.parent / "cache" / "columns"  # see load_replay_columns
+FEATURE_VERSION = 2  # 2: drop samples cached as [] by failed parses
+
 # Action category mapping - abstracts race-specific actions
 ACTION_CATEGORIES = {
     # Race-neutral actions - KEEP DISTINCT (these are the fingerprint)
@@ -56,14 +76,92 @@ GLOBAL_NGRAM_TOP_N = {
 
 
 def parse_replay(replay_path: Path) -> dict:
-    """Parse replay with screp."""
-    result = subprocess.run(
+    """Parse replay with screp.
+
+    screp's stdout is read straight off the pipe into one buffer (no
+    communicate() chunk list + join, which briefly holds the JSON twice);
+    stderr goes to a temp file so a chatty screp can't block the pipe.
+    """
+    with tempfile.TemporaryFile() as err, subprocess.Popen(
         [str(SCREP_PATH), "-cmds", str(replay_path)],
-        capture_output=True, text=True, timeout=60
-    )
-    if result.returncode != 0:
-        raise RuntimeError(f"screp failed: {result.stderr}")
-    return json.loads(result.stdout)
+        stdout=subprocess.PIPE, stderr=err
+    ) as proc:
+        timer = threading.Timer(SCREP_TIMEOUT, proc.kill)
+        timer.start()
+        try:
+            out = proc.stdout.read()
+            proc.wait()
+        finally:
+            timer.cancel()
+        if proc.returncode != 0:
+            err.seek(0)
+            # Negative exit = killed by the timeout timer
+            raise RuntimeError(f"screp failed (exit {proc.returncode}): "
+                               f"{err.read().decode(errors='replace')}")
+
+    # Raw bytes straight into the parser (no text decode pass)
+    if orjson is not None:
+        return orjson.loads(out)
+    return json.loads(out)
+
+
+def parse_cache_path(replay_path: Path, stat: os.stat_result) -> Path:
+    """Parsed-replay cache file under PARSE_CACHE_DIR.
+
+    Keyed by file name + size + mtime, none of which a move changes, so the
+    entry survives ingest_new moving the replay out of to_ingest/."""
+    key = f"{replay_path.name}:{stat.st_size}:{stat.st_mtime_ns}"
+    return PARSE_CACHE_DIR / f"{hashlib.sha1(key.encode()).hexdigest()}.npz"
+
+
+def load_replay_columns(replay_path: Path) -> tuple:
+    """Parse a replay into (header, command columns), cached on disk.
+
+    screp output is deterministic per file, so the header and command_columns
+    of every command are saved as a compressed .npz in PARSE_CACHE_DIR (see
+    parse_cache_path). Reruns skip screp and JSON decoding entirely.
+    Type codes are stored with their names and remapped on load, since
+    CMD_TYPE_CODES beyond ACTION_CATEGORIES are assigned per process.
+    """
+    stat = replay_path.stat()
+    cache_path = parse_cache_path(replay_path, stat)
+    try:
+        with np.load(cache_path, allow_pickle=False) as cached:
+            if (int(cached["version"]) == PARSE_CACHE_VERSION
+                    and int(cached["src_size"]) == stat.st_size
+                    and int(cached["src_mtime_ns"]) == stat.st_mtime_ns):
+                header = json.loads(cached["header"].item())
+                codes = np.array([cmd_type_code(name) for name in cached["type_names"].tolist()],
+                                 dtype=np.int16)
+                cols = {key: cached[f"col_{key}"] for key in COMMAND_COLUMNS}
+                cols["type"] = codes[cols["type"]]
+                return header, cols
+    except (OSError, KeyError, ValueError):
+        pass  # missing, stale-format or corrupt cache: reparse
+
+    data = parse_replay(replay_path)
+    header = data["Header"]
+    cols = command_columns(data.get("Commands", {}).get("Cmds", []))
+
+    try:
+        # Write-then-rename so concurrent workers never see a partial file
+        PARSE_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=cache_path.parent, suffix=".tmp",
+                                         delete=False) as f:
+            np.savez_compressed(
+                f,
+                version=PARSE_CACHE_VERSION,
+                src_size=stat.st_size,
+                src_mtime_ns=stat.st_mtime_ns,
+                header=json.dumps(header),
+                type_names=np.array(CMD_TYPE_NAMES),
+                **{f"col_{key}": col for key, col in cols.items()},
+            )
+        os.replace(f.name, cache_path)
+    except OSError:
+        pass  # unwritable cache dir: just go uncached
+
+    return header, cols
 
 
 def trim_at_leave(player_cmds: list, all_cmds: list, game_frames: int) -> tuple:
@@ -76,7 +174,12 @@ def trim_at_leave(player_cmds: list, all_cmds: list, game_frames: int) -> tuple:
             break
 
     if leave_frame is not None:
-        player_cmds = [c for c in player_cmds if c["Frame"] <= leave_frame]
+        # Commands are in frame order: only the tail after the leave needs
+        # looking at, not a filter over the whole list
+        end = len(player_cmds)
+        while end and player_cmds[end - 1]["Frame"] > leave_frame:
+            end -= 1
+        player_cmds = player_cmds[:end]
         game_frames = min(game_frames, leave_frame)
 
     return player_cmds, game_frames
@@ -94,21 +197,197 @@ def collapse_consecutive_prod(categories: list) -> list:
     return collapsed
 
 
+def mean_std(values) -> tuple:
+    """(mean, sample std) of a non-empty 1-D array, sharing one mean pass
+    (ndarray.std recomputes the mean). Std is 0 for a single value."""
+    mean = values.mean()
+    if values.size < 2:
+        return float(mean), 0
+    dev = values - mean
+    return float(mean), float(np.sqrt(np.dot(dev, dev) / (values.size - 1)))
+
+
+def count_ngrams(tokens: list, n: int) -> Counter:
+    """Count "_"-joined n-grams over a token list (see count_code_ngrams)."""
+    if len(tokens) < n:
+        return Counter()
+
+    vocab = {}
+    codes = np.fromiter((vocab.setdefault(t, len(vocab)) for t in tokens),
+                        dtype=np.int64, count=len(tokens))
+    return count_code_ngrams(codes, list(vocab), n)
+
+
+def count_code_ngrams(codes, names: list, n: int) -> Counter:
+    """Count "_"-joined n-grams over an int code array, names[code] per token.
+
+    Each window is packed into one exact integer key (base = len(names)), so
+    counting is a single np.unique; only the distinct grams are joined back
+    into strings, in first-occurrence order (keeps Counter.most_common tie
+    order stable for two-pass selection). Gram strings are interned so every
+    sample shares one key object per gram.
+    """
+    if len(codes) < n:
+        return Counter()
+
+    windows = sliding_window_view(codes.astype(np.int64, copy=False), n)
+    keys = windows @ (len(names) ** np.arange(n - 1, -1, -1, dtype=np.int64))
+    _, first_idx, counts = np.unique(keys, return_index=True, return_counts=True)
+    order = np.argsort(first_idx)
+    grams = windows[first_idx[order]].tolist()
+    return Counter({
+        sys.intern("_".join([names[c] for c in gram])): count
+        for gram, count in zip(grams, counts[order].tolist())
+    })
+
+
 def extract_abstracted_ngrams(commands: list, n: int) -> Counter:
     """Extract n-grams using abstracted action categories with consecutive dedup."""
     categories = [ACTION_CATEGORIES.get(c["Type"]["Name"], "O") for c in commands]
-    categories = collapse_consecutive_prod(categories)
-    ngrams = Counter()
-    for i in range(len(categories) - n + 1):
-        gram = "_".join(categories[i:i+n])
-        ngrams[gram] += 1
-    return ngrams
+    return count_ngrams(collapse_consecutive_prod(categories), n)
+
+
+# Action category <-> small int code ("O" = any uncategorized command)
+CATEGORY_NAMES = list(dict.fromkeys([*ACTION_CATEGORIES.values(), "O"]))
+CATEGORY_CODES = {cat: i for i, cat in enumerate(CATEGORY_NAMES)}
+PROD_CATEGORY_CODE = CATEGORY_CODES["Prod"]
+
+
+# Command type name <-> small int code. ACTION_CATEGORIES names come first so
+# their codes are fixed; any other name is appended on first sight (per process)
+CMD_TYPE_CODES = {name: i for i, name in enumerate(ACTION_CATEGORIES)}
+CMD_TYPE_NAMES = list(CMD_TYPE_CODES)
+# Category code per type code (parallel to CMD_TYPE_NAMES), so abstracting a
+# type column is one gather instead of an ACTION_CATEGORIES.get per command
+TYPE_CATEGORY_CODES = [CATEGORY_CODES[ACTION_CATEGORIES[name]] for name in CMD_TYPE_NAMES]
+
+
+def cmd_type_code(name: str) -> int:
+    """CMD_TYPE_CODES code for a command type name, registering it if unseen."""
+    code = CMD_TYPE_CODES.get(name)
+    if code is None:
+        code = CMD_TYPE_CODES[name] = len(CMD_TYPE_NAMES)
+        CMD_TYPE_NAMES.append(name)
+        TYPE_CATEGORY_CODES.append(CATEGORY_CODES[ACTION_CATEGORIES.get(name, "O")])
+    return code
+
+
+HOTKEY_CODE = CMD_TYPE_CODES["Hotkey"]
+SELECT_CODE = CMD_TYPE_CODES["Select"]
+SELECT_ADD_CODE = CMD_TYPE_CODES["Select Add"]
+RIGHT_CLICK_CODE = CMD_TYPE_CODES["Right Click"]
+TARGETED_ORDER_CODE = CMD_TYPE_CODES["Targeted Order"]
+SELECT_TYPE_CODES = [CMD_TYPE_CODES[n] for n in ("Select", "Select Add", "Select Remove")]
+SA_FROM_CODES = [SELECT_CODE, HOTKEY_CODE]  # select→action latency starts at these...
+SA_SKIP_CODES = SELECT_TYPE_CODES + [HOTKEY_CODE]  # ...and ends at anything else
+LEAVE_GAME_CODE = cmd_type_code("Leave Game")
+
+
+def type_mask(types, codes: list):
+    """Boolean mask of `types` entries that are in `codes`.
+
+    One gather from a per-code lookup table — branchless, and about twice as
+    fast as np.isin, which sorts its inputs."""
+    table = np.zeros(len(CMD_TYPE_NAMES), dtype=bool)
+    table[codes] = True
+    return table[types]
+
+
+# Keys of the command_columns dict, in order
+COMMAND_COLUMNS = ("frame", "type", "player_id", "group", "assign", "x", "y",
+                   "has_pos", "n_tags", "has_tags", "queued")
+
+
+def command_columns(commands: list) -> dict:
+    """Project screp command dicts into struct-of-arrays NumPy columns.
+
+    One Python pass unpacks each dict; everything downstream is masks and
+    reductions over contiguous arrays. Hotkey fields are only filled for
+    Hotkey commands (group 0 / not assign elsewhere), positions only where
+    "Pos" is present (see has_pos), tag counts only for Select commands
+    carrying "UnitTags" (see has_tags).
+    """
+    frame, type_code, player_id = [], [], []
+    group, assign = [], []
+    pos_x, pos_y, has_pos = [], [], []
+    n_tags, has_tags, queued = [], [], []
+
+    for c in commands:
+        name = c["Type"]["Name"]
+        code = CMD_TYPE_CODES.get(name)
+        if code is None:
+            code = cmd_type_code(name)
+        frame.append(c["Frame"])
+        type_code.append(code)
+        player_id.append(c["PlayerID"])
+
+        if code == HOTKEY_CODE:
+            group.append(c.get("Group", 0))
+            assign.append(c.get("HotkeyType", {}).get("Name") == "Assign")
+        else:
+            group.append(0)
+            assign.append(False)
+
+        pos = c.get("Pos")
+        if pos is not None:
+            pos_x.append(pos["X"])
+            pos_y.append(pos["Y"])
+            has_pos.append(True)
+        else:
+            pos_x.append(0)
+            pos_y.append(0)
+            has_pos.append(False)
+
+        # Only selection sizes are ever used, so other commands skip the tag lookups
+        if code == SELECT_CODE and "UnitTags" in c:
+            tags = c["UnitTags"]
+            n_tags.append(len(tags) if tags is not None else 0)
+            has_tags.append(True)
+        else:
+            n_tags.append(0)
+            has_tags.append(False)
+        queued.append(bool(c.get("Queued", False)))
+
+    # fromiter with a known count fills each column directly (np.array first
+    # scans the list to infer its shape and type)
+    n = len(frame)
+    return {
+        "frame": np.fromiter(frame, dtype=np.int64, count=n),
+        "type": np.fromiter(type_code, dtype=np.int16, count=n),
+        "player_id": np.fromiter(player_id, dtype=np.int16, count=n),
+        "group": np.fromiter(group, dtype=np.int16, count=n),
+        "assign": np.fromiter(assign, dtype=bool, count=n),
+        "x": np.fromiter(pos_x, dtype=np.int32, count=n),
+        "y": np.fromiter(pos_y, dtype=np.int32, count=n),
+        "has_pos": np.fromiter(has_pos, dtype=bool, count=n),
+        "n_tags": np.fromiter(n_tags, dtype=np.int16, count=n),
+        "has_tags": np.fromiter(has_tags, dtype=bool, count=n),
+        "queued": np.fromiter(queued, dtype=bool, count=n),
+    }
+
+
+def select_columns(cols: dict, mask) -> dict:
+    """Apply one boolean mask (or index array) to every command column."""
+    return {key: col[mask] for key, col in cols.items()}
+
+
+def first_leave_frame(cols: dict):
+    """Frame of the first Leave Game command by any player, or None."""
+    leave_idx = np.flatnonzero(cols["type"] == LEAVE_GAME_CODE)
+    return int(cols["frame"][leave_idx[0]]) if leave_idx.size else None
 
 
 def extract_features(commands: list, game_frames: int) -> tuple:
     """Extract base features + raw n-gram counters (for two-pass selection)."""
     if len(commands) < MIN_COMMANDS:
         return None, None
+    return extract_column_features(command_columns(commands), game_frames)
+
+
+def extract_column_features(cols: dict, game_frames: int) -> tuple:
+    """extract_features over command columns (see command_columns)."""
+    if cols["frame"].size < MIN_COMMANDS:
+        return None, None
 
     game_minutes = (game_frames * FRAME_MS) / 1000 / 60
     if game_minutes < MIN_GAME_MINUTES:
@@ -117,173 +396,161 @@ def extract_features(commands: list, game_frames: int) -> tuple:
     features = {}
     raw_ngrams = {}
 
+    # Every block below is masks and reductions over the command columns
+    frames = cols["frame"]
+    types = cols["type"]
+    n_cmds = frames.size
+    # Commands per type code, one histogram pass for all the per-type counts
+    type_counts = np.bincount(types, minlength=len(CMD_TYPE_NAMES)).tolist()
+    early_cutoff = int(2 * FRAMES_PER_MINUTE)
+    frames_per_min = int(FRAMES_PER_MINUTE)
+
     # === TIMING PATTERNS ===
-    frames = [c["Frame"] for c in commands]
-    gaps = [frames[i] - frames[i-1] for i in range(1, len(frames))]
-
-    if gaps:
-        gaps_ms = [g * FRAME_MS for g in gaps]
-        features["gap_mean"] = statistics.mean(gaps_ms)
-        features["gap_std"] = statistics.stdev(gaps_ms) if len(gaps_ms) > 1 else 0
-        features["gap_median"] = statistics.median(gaps_ms)
-        features["rapid_ratio"] = sum(1 for g in gaps_ms if g < 100) / len(gaps_ms)
-        features["moderate_ratio"] = sum(1 for g in gaps_ms if 100 <= g < 300) / len(gaps_ms)
-        features["slow_ratio"] = sum(1 for g in gaps_ms if g >= 500) / len(gaps_ms)
+    # Inter-command gaps as one int64 array — stats and threshold counts are single C passes
+    gaps_ms = np.diff(frames) * FRAME_MS
+    n_gaps = gaps_ms.size
+
+    if n_gaps:
+        features["gap_mean"], features["gap_std"] = mean_std(gaps_ms)
+        features["gap_median"] = float(np.median(gaps_ms))
+        features["rapid_ratio"] = np.count_nonzero(gaps_ms < 100) / n_gaps
+        features["moderate_ratio"] = np.count_nonzero((gaps_ms >= 100) & (gaps_ms < 300)) / n_gaps
+        features["slow_ratio"] = np.count_nonzero(gaps_ms >= 500) / n_gaps
         features["burstiness"] = features["gap_std"] / features["gap_mean"] if features["gap_mean"] > 0 else 0
 
     # === HOTKEY PATTERNS ===
-    hotkey_cmds = [c for c in commands if c["Type"]["Name"] == "Hotkey"]
-    if hotkey_cmds:
-        groups = [c.get("Group", 0) for c in hotkey_cmds]
+    # Hotkey sub-columns, gathered once; the early-game block reuses them too
+    hk_idx = np.flatnonzero(types == HOTKEY_CODE)
+    hk_groups = cols["group"][hk_idx]
+    hk_frames = frames[hk_idx]
+    hk_assign = cols["assign"][hk_idx]
+    n_hotkeys = hk_idx.size
+    if n_hotkeys:
+        groups = hk_groups.tolist()
         group_counts = Counter(groups)
         features["hotkey_diversity"] = len(group_counts)
         top_2 = sum(c for _, c in group_counts.most_common(2))
-        features["hotkey_concentration"] = top_2 / len(hotkey_cmds)
-        assigns = sum(1 for c in hotkey_cmds if c.get("HotkeyType", {}).get("Name") == "Assign")
-        features["hotkey_assign_ratio"] = assigns / len(hotkey_cmds)
-        features["hotkey_action_ratio"] = len(hotkey_cmds) / len(commands)
+        features["hotkey_concentration"] = top_2 / n_hotkeys
+        features["hotkey_assign_ratio"] = np.count_nonzero(hk_assign) / n_hotkeys
+        features["hotkey_action_ratio"] = n_hotkeys / n_cmds
         most_common_group = group_counts.most_common(1)[0][0] if group_counts else 0
         features["primary_hotkey_group"] = most_common_group
+        # Group numbers double as n-gram token codes (see count_code_ngrams)
+        group_names = [str(g) for g in range(max(group_counts) + 1)]
 
         # === HOTKEY GROUP TRANSITION MATRIX ===
         if len(groups) > 5:
             used_groups = sorted(group_counts.keys())
-            transitions = Counter()
-            for i in range(1, len(groups)):
-                transitions[(groups[i-1], groups[i])] += 1
+            # Dense group x group count matrix; a row sum is every transition out of a group
+            n_slots = used_groups[-1] + 1
+            transitions = np.zeros((n_slots, n_slots), dtype=np.int64)
+            np.add.at(transitions, (hk_groups[:-1], hk_groups[1:]), 1)
+            from_totals = transitions.sum(axis=1).tolist()
             for g_from in used_groups[:5]:
-                from_total = sum(transitions[(g_from, g_to)] for g_to in used_groups)
+                from_total = from_totals[g_from]
                 if from_total > 0:
+                    row = transitions[g_from].tolist()
                     for g_to in used_groups[:5]:
-                        prob = transitions[(g_from, g_to)] / from_total
+                        prob = row[g_to] / from_total
                         if prob > 0:
                             features[f"hk_tr_{g_from}_{g_to}"] = prob
 
         # === PER-GROUP DOUBLE-TAP TIMING ===
         # How fast you double-tap each control group (median ms between consecutive same-group presses)
-        hk_frames_list = [(c.get("Group", 0), c["Frame"]) for c in hotkey_cmds]
-        dt_gaps_by_group = defaultdict(list)
-        for i in range(1, len(hk_frames_list)):
-            g1, f1 = hk_frames_list[i - 1]
-            g2, f2 = hk_frames_list[i]
-            if g1 == g2:
-                gap_ms = (f2 - f1) * FRAME_MS
-                dt_gaps_by_group[g1].append(gap_ms)
+        # === GROUP-SWITCH VELOCITY ===
+        # How fast you transition between different control groups
+        hk_gaps_ms = np.diff(hk_frames) * FRAME_MS
+        same_group = hk_groups[1:] == hk_groups[:-1]
 
         for g in range(6):  # groups 0-5 (most commonly used)
-            gaps_g = dt_gaps_by_group.get(g, [])
-            if len(gaps_g) >= 5:
-                features[f"dt_median_g{g}"] = statistics.median(gaps_g)
+            gaps_g = hk_gaps_ms[same_group & (hk_groups[1:] == g)]
+            if gaps_g.size >= 5:
+                features[f"dt_median_g{g}"] = float(np.median(gaps_g))
             else:
                 features[f"dt_median_g{g}"] = 0
 
-        # === GROUP-SWITCH VELOCITY ===
-        # How fast you transition between different control groups
-        switch_gaps = []
-        for i in range(1, len(hk_frames_list)):
-            g1, f1 = hk_frames_list[i - 1]
-            g2, f2 = hk_frames_list[i]
-            if g1 != g2:
-                switch_gaps.append((f2 - f1) * FRAME_MS)
-
-        if switch_gaps:
-            features["group_switch_median"] = statistics.median(switch_gaps)
-            features["group_switch_mean"] = statistics.mean(switch_gaps)
+        switch_gaps = hk_gaps_ms[~same_group]
+        if switch_gaps.size:
+            features["group_switch_median"] = float(np.median(switch_gaps))
+            features["group_switch_mean"] = float(switch_gaps.mean())
 
         # === FIRST ASSIGN ORDER (2nd and 3rd groups) ===
         # Which control groups you set up and in what order
-        first_assign_frame = {}
-        for c in hotkey_cmds:
-            g = c.get("Group", 0)
-            if c.get("HotkeyType", {}).get("Name") == "Assign":
-                if g not in first_assign_frame:
-                    first_assign_frame[g] = c["Frame"]
-
-        assign_order = sorted(first_assign_frame.keys(), key=lambda g: first_assign_frame[g])
+        # (first-assign frame, then first-seen order for ties)
+        assign_groups = hk_groups[hk_assign]
+        assigned, first_idx = np.unique(assign_groups, return_index=True)
+        first_frames = hk_frames[hk_assign][first_idx]
+        assign_order = assigned[np.lexsort((first_idx, first_frames))].tolist()
         for i in range(1, 4):  # 2nd, 3rd, 4th assigned groups (1st is already first_assign_0)
             features[f"assign_order_{i}"] = assign_order[i] if i < len(assign_order) else -1
 
         # === HOTKEY GROUP N-GRAMS (raw counters for two-pass) ===
         if len(groups) > 10:
-            group_strs = [str(g) for g in groups]
             for n in [2, 3]:
-                grp_ngrams = Counter()
-                for i in range(len(group_strs) - n + 1):
-                    gram = "_".join(group_strs[i:i+n])
-                    grp_ngrams[gram] += 1
+                grp_ngrams = count_code_ngrams(hk_groups, group_names, n)
                 total_gng = sum(grp_ngrams.values())
                 if total_gng > 0:
                     raw_ngrams[f"hkg{n}"] = (grp_ngrams, total_gng)
 
     # === CLICK PATTERNS ===
-    clicks = [(c["Pos"]["X"], c["Pos"]["Y"]) for c in commands if "Pos" in c]
-    if len(clicks) > 10:
-        distances = []
-        for i in range(1, len(clicks)):
-            dx = clicks[i][0] - clicks[i-1][0]
-            dy = clicks[i][1] - clicks[i-1][1]
-            distances.append((dx**2 + dy**2) ** 0.5)
-        features["click_dist_mean"] = statistics.mean(distances)
-        features["click_dist_std"] = statistics.stdev(distances) if len(distances) > 1 else 0
-        features["click_dist_median"] = statistics.median(distances)
-        features["small_move_ratio"] = sum(1 for d in distances if d < 100) / len(distances)
-        features["big_jump_ratio"] = sum(1 for d in distances if d > 1000) / len(distances)
+    click_idx = np.flatnonzero(cols["has_pos"])
+    n_clicks = click_idx.size
+    if n_clicks > 10:
+        # Euclidean distance between consecutive clicks, in one vectorized pass
+        distances = np.hypot(np.diff(cols["x"][click_idx]), np.diff(cols["y"][click_idx]))
+        n_dist = distances.size
+        features["click_dist_mean"], features["click_dist_std"] = mean_std(distances)
+        features["click_dist_median"] = float(np.median(distances))
+        features["small_move_ratio"] = np.count_nonzero(distances < 100) / n_dist
+        features["big_jump_ratio"] = np.count_nonzero(distances > 1000) / n_dist
 
     # === EARLY GAME ===
-    early_cutoff = int(2 * FRAMES_PER_MINUTE)
-    early_cmds = [c for c in commands if c["Frame"] < early_cutoff]
-    if len(early_cmds) > 20:
-        features["early_apm"] = len(early_cmds) / 2.0
-        early_gaps = [(early_cmds[i]["Frame"] - early_cmds[i-1]["Frame"]) * FRAME_MS
-                      for i in range(1, len(early_cmds))]
-        if early_gaps:
-            features["early_gap_mean"] = statistics.mean(early_gaps)
-            features["early_rapid_ratio"] = sum(1 for g in early_gaps if g < 100) / len(early_gaps)
-
-        early_hotkeys = [c for c in early_cmds if c["Type"]["Name"] == "Hotkey"]
-        early_assigns = [c.get("Group", 0) for c in early_hotkeys
-                        if c.get("HotkeyType", {}).get("Name") == "Assign"]
+    # Commands come in frame order, so the early game is a prefix: a binary
+    # search finds its end (and the hotkeys' end) instead of a full-length mask
+    n_early = int(np.searchsorted(frames, early_cutoff))
+    early_frames = frames[:n_early]
+    if early_frames.size > 20:
+        features["early_apm"] = early_frames.size / 2.0
+        early_gaps = np.diff(early_frames) * FRAME_MS
+        if early_gaps.size:
+            features["early_gap_mean"] = float(early_gaps.mean())
+            features["early_rapid_ratio"] = np.count_nonzero(early_gaps < 100) / early_gaps.size
+
+        n_hk_early = int(np.searchsorted(hk_idx, n_early))
+        early_assigns = hk_groups[:n_hk_early][hk_assign[:n_hk_early]][:3].tolist()
         for i in range(3):
             features[f"first_assign_{i}"] = early_assigns[i] if i < len(early_assigns) else -1
 
         # Early hotkey group n-grams (raw counters for two-pass)
-        early_groups = [c.get("Group", 0) for c in early_hotkeys]
-        if len(early_groups) > 5:
-            early_grp_strs = [str(g) for g in early_groups]
+        early_groups = hk_groups[:n_hk_early]
+        if early_groups.size > 5:
             for n in [2, 3]:
-                early_gng = Counter()
-                for i in range(len(early_grp_strs) - n + 1):
-                    gram = "_".join(early_grp_strs[i:i+n])
-                    early_gng[gram] += 1
+                early_gng = count_code_ngrams(early_groups, group_names, n)
                 total_egng = sum(early_gng.values())
                 if total_egng > 0:
                     raw_ngrams[f"ehkg{n}"] = (early_gng, total_egng)
 
     # === OTHER RACE-NEUTRAL ===
-    queued = sum(1 for c in commands if c.get("Queued", False))
-    features["queued_ratio"] = queued / len(commands)
+    features["queued_ratio"] = np.count_nonzero(cols["queued"]) / n_cmds
 
     # === SELECTION PATTERNS ===
-    selections = [c for c in commands if c["Type"]["Name"] == "Select"]
-    select_adds = [c for c in commands if c["Type"]["Name"] == "Select Add"]
-    if selections:
-        sizes = [len(c.get("UnitTags", [])) for c in selections if "UnitTags" in c]
-        if sizes:
-            features["select_size_mean"] = statistics.mean(sizes)
-            features["select_size_std"] = statistics.stdev(sizes) if len(sizes) > 1 else 0
-        features["selection_action_ratio"] = len(selections) / len(commands)
+    n_selections = type_counts[SELECT_CODE]
+    if n_selections:
+        sizes = cols["n_tags"][cols["has_tags"]]
+        if sizes.size:
+            features["select_size_mean"], features["select_size_std"] = mean_std(sizes)
+        features["selection_action_ratio"] = n_selections / n_cmds
 
         # Select Add ratio — shift-clicker vs drag-boxer vs pure hotkey
-        features["select_add_ratio"] = len(select_adds) / len(selections) if selections else 0
+        features["select_add_ratio"] = type_counts[SELECT_ADD_CODE] / n_selections
 
         # Selection tempo — time gaps between consecutive select-type commands
-        select_cmds = [c for c in commands if c["Type"]["Name"] in ("Select", "Select Add", "Select Remove")]
-        if len(select_cmds) > 5:
-            sel_gaps_ms = [(select_cmds[i]["Frame"] - select_cmds[i-1]["Frame"]) * FRAME_MS
-                          for i in range(1, len(select_cmds))]
-            features["select_gap_mean"] = statistics.mean(sel_gaps_ms)
-            features["select_gap_median"] = statistics.median(sel_gaps_ms)
-            features["reselect_burst_ratio"] = sum(1 for g in sel_gaps_ms if g < 200) / len(sel_gaps_ms)
+        select_frames = frames[type_mask(types, SELECT_TYPE_CODES)]
+        if select_frames.size > 5:
+            sel_gaps_ms = np.diff(select_frames) * FRAME_MS
+            features["select_gap_mean"] = float(sel_gaps_ms.mean())
+            features["select_gap_median"] = float(np.median(sel_gaps_ms))
+            features["reselect_burst_ratio"] = np.count_nonzero(sel_gaps_ms < 200) / sel_gaps_ms.size
 
     # TODO: Selection size distribution shape (binned) — disabled, may correlate with race/game-state
     # pct_select_1    = count(size == 1)  / total    # single click
@@ -292,86 +559,79 @@ def extract_features(commands: list, game_frames: int) -> tuple:
     # pct_select_9_12 = count(9 <= s <= 12) / total  # fat drag box (BW max 12)
 
     # === SELECT→ACTION LATENCY (race-invariant motor pattern) ===
-    sa_gaps = []
-    for i in range(len(commands) - 1):
-        if commands[i]["Type"]["Name"] in ("Select", "Hotkey"):
-            if commands[i+1]["Type"]["Name"] not in ("Select", "Select Add", "Select Remove", "Hotkey"):
-                gap = (commands[i+1]["Frame"] - commands[i]["Frame"]) * FRAME_MS
-                if gap < 2000:
-                    sa_gaps.append(gap)
-    if sa_gaps:
-        features["sa_latency_mean"] = statistics.mean(sa_gaps)
-        features["sa_latency_median"] = statistics.median(sa_gaps)
+    # A Select/Hotkey directly followed by a non-selection command, within 2s
+    sa_pairs = type_mask(types[:-1], SA_FROM_CODES) & ~type_mask(types[1:], SA_SKIP_CODES)
+    sa_gaps = gaps_ms[sa_pairs]
+    sa_gaps = sa_gaps[sa_gaps < 2000]
+    if sa_gaps.size:
+        features["sa_latency_mean"] = float(sa_gaps.mean())
+        features["sa_latency_median"] = float(np.median(sa_gaps))
 
     # === BURST STRUCTURE (race-invariant rhythm) ===
-    if gaps:
+    if n_gaps:
         burst_threshold_ms = 150
-        bursts = []
-        current_burst = 1
-        for g in gaps_ms:
-            if g < burst_threshold_ms:
-                current_burst += 1
-            else:
-                if current_burst > 1:
-                    bursts.append(current_burst)
-                current_burst = 1
-        if current_burst > 1:
-            bursts.append(current_burst)
+        # A burst is a run of k fast gaps (k + 1 commands); run edges come from
+        # the rises/falls of the zero-padded fast mask
+        fast = gaps_ms < burst_threshold_ms
+        edges = np.flatnonzero(np.diff(np.concatenate(([0], fast.view(np.int8), [0]))))
+        bursts = edges[1::2] - edges[::2] + 1
 
-        if bursts:
-            features["burst_count_per_min"] = len(bursts) / game_minutes
-            features["burst_size_mean"] = statistics.mean(bursts)
+        if bursts.size:
+            features["burst_count_per_min"] = bursts.size / game_minutes
+            features["burst_size_mean"] = float(bursts.mean())
 
-        inter_burst_gaps = [g for g in gaps_ms if g >= burst_threshold_ms]
-        if inter_burst_gaps:
-            features["inter_burst_gap_mean"] = statistics.mean(inter_burst_gaps)
+        inter_burst_gaps = gaps_ms[~fast]
+        if inter_burst_gaps.size:
+            features["inter_burst_gap_mean"] = float(inter_burst_gaps.mean())
 
     # === RHYTHM AUTOCORRELATION (race-invariant timing signature) ===
-    if len(gaps) > 20:
-        g_arr = np.array(gaps_ms[:200])
+    if n_gaps > 20:
+        g_arr = gaps_ms[:200]
         g_centered = g_arr - g_arr.mean()
-        var = np.sum(g_centered ** 2)
+        # Dot products: no squared / shifted-product temporaries
+        var = np.dot(g_centered, g_centered)
         if var > 0:
-            features["autocorr_lag1"] = float(np.sum(g_centered[:-1] * g_centered[1:]) / var)
+            features["autocorr_lag1"] = float(np.dot(g_centered[:-1], g_centered[1:]) / var)
 
     # === MAP JUMPS (multitask switching — race-invariant) ===
-    if len(clicks) > 10:
-        map_jumps = 0
-        click_frames = [(c["Pos"]["X"], c["Pos"]["Y"], c["Frame"]) for c in commands if "Pos" in c]
-        for i in range(1, len(click_frames)):
-            dx = click_frames[i][0] - click_frames[i-1][0]
-            dy = click_frames[i][1] - click_frames[i-1][1]
-            dist = (dx**2 + dy**2) ** 0.5
-            time_gap = (click_frames[i][2] - click_frames[i-1][2]) * FRAME_MS
-            if dist > 2000 and time_gap < 500:
-                map_jumps += 1
+    if n_clicks > 10:
+        click_gaps_ms = np.diff(frames[click_idx]) * FRAME_MS
+        map_jumps = np.count_nonzero((distances > 2000) & (click_gaps_ms < 500))
         features["map_jumps_per_min"] = map_jumps / game_minutes
 
-    features["apm"] = len(commands) / game_minutes
-
-    frames_per_min = int(FRAMES_PER_MINUTE)
-    apm_buckets = Counter(c["Frame"] // frames_per_min for c in commands)
-    apm_curve = [apm_buckets.get(i, 0) for i in range(10)]
-    if len(apm_curve) >= 5:
-        early_apm_avg = statistics.mean(apm_curve[:3]) if apm_curve[:3] else 0
-        late_apm_avg = statistics.mean(apm_curve[5:8]) if len(apm_curve) > 5 else 0
-        features["apm_decay"] = (early_apm_avg - late_apm_avg) / early_apm_avg if early_apm_avg > 0 else 0
-        features["apm_variance"] = statistics.stdev(apm_curve[:8]) if len(apm_curve) >= 8 else 0
-
-    cmd_types = Counter(c["Type"]["Name"] for c in commands)
-    total = sum(cmd_types.values())
-    features["pct_hotkey"] = cmd_types.get("Hotkey", 0) / total
-    features["pct_right_click"] = cmd_types.get("Right Click", 0) / total
-    features["pct_select"] = cmd_types.get("Select", 0) / total
-    features["pct_targeted_order"] = cmd_types.get("Targeted Order", 0) / total
-
-    thinking = cmd_types.get("Hotkey", 0) + cmd_types.get("Select", 0)
-    doing = cmd_types.get("Right Click", 0) + cmd_types.get("Targeted Order", 0)
+    features["apm"] = n_cmds / game_minutes
+
+    # Commands per game minute, first 10 minutes
+    # (minlength keeps all 10 minutes, so the short-game guards are gone; the
+    # 3-minute averages are plain Python sums — too small for NumPy dispatch)
+    apm_curve = np.bincount(frames // frames_per_min, minlength=10)[:10]
+    curve = apm_curve.tolist()
+    early_apm_avg = sum(curve[:3]) / 3
+    late_apm_avg = sum(curve[5:8]) / 3
+    features["apm_decay"] = (early_apm_avg - late_apm_avg) / early_apm_avg if early_apm_avg > 0 else 0
+    features["apm_variance"] = mean_std(apm_curve[:8])[1]
+
+    n_right_click = type_counts[RIGHT_CLICK_CODE]
+    n_targeted = type_counts[TARGETED_ORDER_CODE]
+    features["pct_hotkey"] = n_hotkeys / n_cmds
+    features["pct_right_click"] = n_right_click / n_cmds
+    features["pct_select"] = n_selections / n_cmds
+    features["pct_targeted_order"] = n_targeted / n_cmds
+
+    thinking = n_hotkeys + n_selections
+    doing = n_right_click + n_targeted
     features["think_do_ratio"] = thinking / doing if doing > 0 else 0
 
     # === ABSTRACTED N-GRAMS (raw counters for two-pass) ===
+    # Category codes via the type-code lookup table; consecutive Prod runs are
+    # collapsed with one mask (collapse_consecutive_prod, vectorized)
+    categories = np.array(TYPE_CATEGORY_CODES, dtype=np.int64)[types]
+    is_prod = categories == PROD_CATEGORY_CODE
+    keep = np.ones(categories.size, dtype=bool)
+    keep[1:] = ~(is_prod[1:] & is_prod[:-1])
+    categories = categories[keep]
     for n in [2, 3, 4]:
-        ngrams = extract_abstracted_ngrams(commands, n)
+        ngrams = count_code_ngrams(categories, CATEGORY_NAMES, n)
         total_ng = sum(ngrams.values())
         if total_ng > 0:
             raw_ngrams[f"ng{n}"] = (ngrams, total_ng)
@@ -381,13 +641,12 @@ def extract_features(commands: list, game_frames: int) -> tuple:
 
 def select_global_ngrams(all_raw_ngrams):
     """Two-pass: aggregate n-gram counts across all samples and pick global top-N."""
-    global_counts = {}
+    global_counts = defaultdict(Counter)
 
     for sample_ngrams in all_raw_ngrams:
         for prefix, (counter, total) in sample_ngrams.items():
-            if prefix not in global_counts:
-                global_counts[prefix] = Counter()
-            global_counts[prefix] += counter
+            # update() adds in place; += would rescan the whole running total
+            global_counts[prefix].update(counter)
 
     selected = {}
     for prefix, counter in global_counts.items():
@@ -397,6 +656,18 @@ def select_global_ngrams(all_raw_ngrams):
     return selected
 
 
+def compact_raw_ngrams(raw_ngrams, global_ngrams):
+    """Keep only the globally-selected grams of a sample's n-gram counters.
+
+    Totals are preserved, so apply_ngram_features gives the same values.
+    """
+    compact = {}
+    for prefix, (counter, total) in raw_ngrams.items():
+        selected = global_ngrams.get(prefix, ())
+        compact[prefix] = ({gram: counter[gram] for gram in selected if gram in counter}, total)
+    return compact
+
+
 def apply_ngram_features(features, raw_ngrams, global_ngrams):
     """Apply globally-selected n-gram set to a single sample's features."""
     for prefix, selected_grams in global_ngrams.items():
@@ -405,6 +676,19 @@ def apply_ngram_features(features, raw_ngrams, global_ngrams):
             features[f"{prefix}_{gram}"] = counter.get(gram, 0) / total if total > 0 else 0
 
 
+def open_db(db_path):
+    """Open the replay DB for the read-heavy sample lookups.
+
+    sqlite3 already caches compiled statements per connection, so repeated
+    queries reuse their plans; the PRAGMAs keep the working set in RAM.
+    """
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA cache_size = -64000")  # 64 MB page cache
+    conn.execute("PRAGMA temp_store = MEMORY")
+    conn.execute("PRAGMA mmap_size = 268435456")  # memory-map up to 256 MB
+    return conn
+
+
 def get_player_replays(conn, player_name: str, year: str = None, min_date: str = None):
     """Legacy: Get replay paths for a player by display name."""
     c = conn.cursor()
@@ -437,51 +721,98 @@ def get_player_replays(conn, player_name: str, year: str = None, min_date: str =
     return c.fetchall()
 
 
-def extract_player_samples(conn, player_name: str, label: str = None,
-                           year: str = None, min_date: str = None,
-                           max_games: int = 30):
-    """Legacy: Extract feature samples for a player by display name."""
-    replays = get_player_replays(conn, player_name, year=year, min_date=min_date)
-    if label is None:
-        label = player_name
+def process_replay(file_path, replay_id, player_name, label, feature_version=FEATURE_VERSION):
+    """Parse one replay and extract feature samples for `player_name`.
+    Runs in a worker process. Returns a (possibly empty) list of sample dicts.
+
+    Called through cached_process_replay, which caches results on disk by
+    arguments so reruns skip parsing and extraction entirely.
+    `feature_version` is only part of the cache key — bump FEATURE_VERSION
+    whenever extract_features output changes.
+
+    Parse failures raise (joblib.Memory never stores a raised call), so a
+    screp timeout or corrupt cache is retried next run; see try_process_replay.
+    """
+    path = Path(file_path)
     samples = []
+    header, all_cols = load_replay_columns(path)
+    game_frames = header["Frames"]
+
+    # Same trim as trim_at_leave, folded into the player mask: each
+    # player's columns are gathered exactly once, straight from all_cols
+    leave_frame = first_leave_frame(all_cols)
+    if leave_frame is not None:
+        in_game = all_cols["frame"] <= leave_frame
+        game_frames = min(game_frames, leave_frame)
 
-    for file_path, replay_id in replays[:max_games]:
-        path = Path(file_path)
-        if not path.exists():
+    for player in header["Players"]:
+        if player["Type"]["Name"] != "Human":
+            continue
+        if player["Name"] != player_name:
             continue
 
-        try:
-            data = parse_replay(path)
-            all_cmds = data.get("Commands", {}).get("Cmds", [])
-            game_frames = data["Header"]["Frames"]
-
-            for player in data["Header"]["Players"]:
-                if player["Type"]["Name"] != "Human":
-                    continue
-                if player["Name"] != player_name:
-                    continue
-
-                player_cmds = [c for c in all_cmds if c["PlayerID"] == player["ID"]]
-                player_cmds, effective_frames = trim_at_leave(player_cmds, all_cmds, game_frames)
-                features, raw_ngrams = extract_features(player_cmds, effective_frames)
-
-                if features:
-                    samples.append({
-                        "features": features,
-                        "raw_ngrams": raw_ngrams,
-                        "label": label,
-                        "alias": player_name,
-                        "race": player["Race"]["Name"],
-                        "replay_id": replay_id,
-                        "file": path.name,
-                    })
-        except Exception:
-            pass
+        is_player = all_cols["player_id"] == player["ID"]
+        if leave_frame is not None:
+            is_player &= in_game
+        player_cols = select_columns(all_cols, is_player)
+        features, raw_ngrams = extract_column_features(player_cols, game_frames)
+
+        if features:
+            samples.append({
+                "features": features,
+                "raw_ngrams": raw_ngrams,
+                "label": label,
+                "alias": player_name,
+                "race": player["Race"]["Name"],
+                "replay_id": replay_id,
+                "file": path.name,
+            })
 
     return samples
 
 
+cached_process_replay = FEATURE_CACHE.cache(process_replay)
+
+
+def try_process_replay(*args):
+    """cached_process_replay, but a replay that fails to parse is skipped
+    (returns []) for this run only, instead of raising or being cached."""
+    try:
+        return cached_process_replay(*args)
+    except Exception:
+        return []
+
+
+def process_replays(replays, label, workers=None):
+    """Run process_replay over (file_path, replay_id, player_name) rows in
+    parallel across `workers` processes (default: all cores), keeping row order."""
+    # Missing files are skipped up front so they never land in the cache
+    replays = [r for r in replays if Path(r[0]).exists()]
+    if not replays:
+        return []
+
+    file_paths, replay_ids, player_names = zip(*replays)
+    samples = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for replay_samples in executor.map(
+                try_process_replay, file_paths, replay_ids, player_names,
+                repeat(label), chunksize=4):
+            samples.extend(replay_samples)
+    return samples
+
+
+def extract_player_samples(conn, player_name: str, label: str = None,
+                           year: str = None, min_date: str = None,
+                           max_games: int = 30, workers: int = None):
+    """Legacy: Extract feature samples for a player by display name."""
+    replays = get_player_replays(conn, player_name, year=year, min_date=min_date)
+    if label is None:
+        label = player_name
+    return process_replays(
+        [(file_path, replay_id, player_name) for file_path, replay_id in replays[:max_games]],
+        label, workers=workers)
+
+
 
 def get_pro_identities(conn, min_games=10):
     """Get all confirmed pros from player_identities, filtered by modern-era game count.
@@ -493,21 +824,21 @@ def get_pro_identities(conn, min_games=10):
     for canonical, aurora_id in c.fetchall():
         pros[canonical].append(aurora_id)
 
-    result = []
-    for canonical, aurora_ids in pros.items():
-        placeholders = ",".join(["?"] * len(aurora_ids))
-        c.execute(f"""
-            SELECT COUNT(DISTINCT p.replay_id)
-            FROM players p
-            JOIN replays r ON r.id = p.replay_id
-            WHERE p.aurora_id IN ({placeholders})
-              AND p.is_human = 1
-              AND r.game_date >= '2025-01-01'
-        """, aurora_ids)
-        total = c.fetchone()[0]
-        if total >= min_games:
-            result.append((canonical, aurora_ids, total))
-
+    # One grouped count for every pro instead of a COUNT query per pro
+    c.execute("""
+        SELECT pi.canonical_name, COUNT(DISTINCT p.replay_id)
+        FROM player_identities pi
+        JOIN players p ON p.aurora_id = pi.aurora_id
+        JOIN replays r ON r.id = p.replay_id
+        WHERE p.is_human = 1
+          AND r.game_date >= '2025-01-01'
+        GROUP BY pi.canonical_name
+        HAVING COUNT(DISTINCT p.replay_id) >= ?
+    """, (min_games,))
+    totals = dict(c.fetchall())
+
+    result = [(canonical, aurora_ids, totals[canonical])
+              for canonical, aurora_ids in pros.items() if canonical in totals]
     result.sort(key=lambda x: -x[2])
     return result
 
@@ -540,45 +871,10 @@ def get_player_replays_by_aurora(conn, aurora_ids, min_date=None):
     return c.fetchall()
 
 
-def extract_player_samples_by_aurora(conn, aurora_ids, label, min_date=None):
+def extract_player_samples_by_aurora(conn, aurora_ids, label, min_date=None, workers=None):
     """Extract feature samples for a player by aurora_id(s)."""
     replays = get_player_replays_by_aurora(conn, aurora_ids, min_date=min_date)
-    samples = []
-
-    for file_path, replay_id, player_name in replays:
-        path = Path(file_path)
-        if not path.exists():
-            continue
-
-        try:
-            data = parse_replay(path)
-            all_cmds = data.get("Commands", {}).get("Cmds", [])
-            game_frames = data["Header"]["Frames"]
-
-            for player in data["Header"]["Players"]:
-                if player["Type"]["Name"] != "Human":
-                    continue
-                if player["Name"] != player_name:
-                    continue
-
-                player_cmds = [c for c in all_cmds if c["PlayerID"] == player["ID"]]
-                player_cmds, effective_frames = trim_at_leave(player_cmds, all_cmds, game_frames)
-                features, raw_ngrams = extract_features(player_cmds, effective_frames)
-
-                if features:
-                    samples.append({
-                        "features": features,
-                        "raw_ngrams": raw_ngrams,
-                        "label": label,
-                        "alias": player_name,
-                        "race": player["Race"]["Name"],
-                        "replay_id": replay_id,
-                        "file": path.name,
-                    })
-        except Exception:
-            pass
-
-    return samples
+    return process_replays(replays, label, workers=workers)
 
 
 def create_feature_matrix(samples, feature_names=None):
@@ -589,6 +885,14 @@ def create_feature_matrix(samples, feature_names=None):
             all_features.update(s["features"].keys())
         feature_names = sorted(all_features)
 
-    X = np.array([[s["features"].get(f, 0) for f in feature_names] for s in samples])
+    # Preallocated float32 (what sklearn's trees use internally), filled by
+    # column index — features absent from a sample stay 0
+    col_index = {f: i for i, f in enumerate(feature_names)}
+    X = np.zeros((len(samples), len(feature_names)), dtype=np.float32)
+    for row, s in zip(X, samples):
+        for f, v in s["features"].items():
+            i = col_index.get(f)
+            if i is not None:
+                row[i] = v
     y = np.array([s["label"] for s in samples])
     return X, y, feature_names
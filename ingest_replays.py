@@ -5,23 +5,63 @@ Scans directories, extracts metadata, and stores in SQLite for analysis.
 """
 
 import json
+import os
 import re
 import sqlite3
 import subprocess
 import sys
 from pathlib import Path
-from datetime import datetime
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import closing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import hashlib
 
+try:
+    import orjson  # optional: faster decode of screp output
+except ImportError:
+    orjson = None
+
 SCREP_PATH = Path.home() / "go/bin/screp"
 DB_PATH = Path(__file__).parent / "data" / "replays.db"
+SCREP_CACHE_DIR = Path(__file__).parent / "data" / "screp_cache"  # <file_hash>.json header dumps
 FRAME_MS = 42  # 1 frame = 42 milliseconds
+COMMIT_EVERY = 5000  # replays per ingest_directory transaction (each commit is an fsync)
+INSERT_BATCH = 500  # replays buffered per insert_replays call (divides COMMIT_EVERY)
+HASH_POOL_MIN = 64  # fewer replays than this are hashed inline, without a thread pool
+BULK_REINDEX_MIN = 5000  # replays to ingest before the players indexes are dropped and rebuilt
+MATCH_ID_RE = re.compile(r'(MM-[0-9A-Fa-f-]+)')
+
+# players indexes, maintained on every player INSERT
+PLAYER_INDEXES = {
+    "idx_player_name": "players(player_name)",
+    "idx_player_aurora_id": "players(aurora_id)",
+    # Covers the per-pro replay lookups and game counts (aurora_id IN (...) AND is_human = 1)
+    "idx_player_aurora_human": "players(aurora_id, is_human, replay_id, player_name)",
+}
+
+# Fixed SQL strings, so every batch hits the same sqlite3 cached statement
+INSERT_REPLAY_SQL = '''
+    INSERT OR IGNORE INTO replays
+    (file_hash, file_path, file_name, source_dir, map_name,
+     game_date, duration_seconds, frames, version, winner_team, match_id, created_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?,
+            strftime('%Y-%m-%dT%H:%M:%f', 'now', 'localtime'))
+'''
+INSERT_PLAYER_SQL = '''
+    INSERT INTO players (replay_id, slot_id, player_name, race, is_human,
+                         start_x, start_y, start_direction, aurora_id)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
 
 
 def init_db():
     """Initialize SQLite database with schema."""
-    conn = sqlite3.connect(DB_PATH)
+    conn = sqlite3.connect(DB_PATH, cached_statements=256)
+    # Bulk-insert tuning: WAL + NORMAL sync makes commits cheap and crash-safe
+    # (ingest_directory / ingest_new switch back via leave_wal_mode when done)
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    conn.execute("PRAGMA cache_size = -65536")  # 64 MB page cache
     c = conn.cursor()
 
     c.execute('''
@@ -77,42 +117,109 @@ def init_db():
         pass  # column already exists
 
     # Index for fast lookups
-    c.execute('CREATE INDEX IF NOT EXISTS idx_player_name ON players(player_name)')
+    create_player_indexes(c)
     c.execute('CREATE INDEX IF NOT EXISTS idx_game_date ON replays(game_date)')
-    c.execute('CREATE INDEX IF NOT EXISTS idx_player_aurora_id ON players(aurora_id)')
     c.execute('CREATE INDEX IF NOT EXISTS idx_replay_match_id ON replays(match_id)')
 
     conn.commit()
     return conn
 
 
+def leave_wal_mode(conn):
+    """Fold the WAL back into replays.db and return it to rollback-journal mode.
+
+    journal_mode is stored in the DB file itself, and replays.db is tracked in
+    git: left in WAL mode, committed rows could sit in replays.db-wal."""
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.execute("PRAGMA journal_mode = DELETE")
+
+
+def create_player_indexes(c):
+    """Create the players indexes (no-op for ones that exist)."""
+    for name, target in PLAYER_INDEXES.items():
+        c.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {target}")
+
+
+def drop_player_indexes(c):
+    """Drop the players indexes ahead of a bulk load.
+
+    Building them once afterwards is cheaper than updating them per row.
+    init_db recreates them if an ingest dies before create_player_indexes."""
+    for name in PLAYER_INDEXES:
+        c.execute(f"DROP INDEX IF EXISTS {name}")
+
+
+def iter_replay_paths(root: Path):
+    """Yield every .rep file under root.
+
+    An os.scandir walk: entry types come from the directory listing (no
+    per-entry stat) and a Path is only built for the .rep files themselves."""
+    stack = [str(root)]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.endswith(".rep"):
+                    yield Path(entry.path)
+
+
+def has_replays(root: Path) -> bool:
+    """True if any .rep file is under root (stops at the first one)."""
+    # closing(): any() abandons the generator mid-walk, and its open
+    # os.scandir iterator must be closed now, not at garbage collection
+    with closing(iter_replay_paths(root)) as paths:
+        return any(paths)
+
+
 def file_hash(path: Path) -> str:
-    """Get MD5 hash of file for deduplication."""
-    h = hashlib.md5()
+    """Get MD5 hash of file for deduplication.
+
+    Kept as MD5 so new hashes match the file_hash values already stored;
+    it is a dedup key only, not a security check."""
+    h = hashlib.md5(usedforsecurity=False)
     with open(path, 'rb') as f:
-        for chunk in iter(lambda: f.read(8192), b''):
+        # 1 MiB reads: a replay hashes in one or two update() calls
+        for chunk in iter(lambda: f.read(1 << 20), b''):
             h.update(chunk)
     return h.hexdigest()
 
 
-def parse_replay_metadata(replay_path: Path) -> dict:
-    """Extract metadata using screp (no commands, just header)."""
-    result = subprocess.run(
-        [str(SCREP_PATH), "-map", str(replay_path)],
-        capture_output=True,
-        text=True,
-        timeout=30
-    )
-    if result.returncode != 0:
-        raise RuntimeError(f"screp failed: {result.stderr}")
-    return json.loads(result.stdout)
-
+def parse_replay_metadata(replay_path: Path, fhash: str = None) -> dict:
+    """Extract metadata using screp (no commands, just header).
 
-def process_replay(replay_path: Path) -> dict:
-    """Process a single replay file."""
+    With `fhash`, screp's output is cached in SCREP_CACHE_DIR, so re-ingesting
+    the same file (e.g. after a DB rebuild) skips the subprocess."""
+    cache = SCREP_CACHE_DIR / f"{fhash}.json" if fhash else None
+    if cache is not None and cache.exists():
+        out = cache.read_bytes()
+    else:
+        result = subprocess.run(
+            [str(SCREP_PATH), "-map", str(replay_path)],
+            capture_output=True,
+            timeout=30
+        )
+        if result.returncode != 0:
+            raise RuntimeError(f"screp failed: {result.stderr.decode(errors='replace')}")
+        out = result.stdout
+        if cache is not None:
+            # Write-then-rename, so a parallel worker never reads a partial file
+            SCREP_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+            tmp = cache.with_name(f"{cache.name}.{os.getpid()}.tmp")
+            tmp.write_bytes(out)
+            os.replace(tmp, cache)
+    # Raw bytes straight into the parser (no text decode pass)
+    if orjson is not None:
+        return orjson.loads(out)
+    return json.loads(out)
+
+
+def process_replay(replay_path: Path, fhash: str = None) -> dict:
+    """Process a single replay file (hashing it unless `fhash` is given)."""
     try:
-        fhash = file_hash(replay_path)
-        data = parse_replay_metadata(replay_path)
+        if fhash is None:
+            fhash = file_hash(replay_path)
+        data = parse_replay_metadata(replay_path, fhash)
         header = data.get("Header", {})
 
         # Extract game date
@@ -132,20 +239,21 @@ def process_replay(replay_path: Path) -> dict:
         winner_team = computed.get("WinnerTeam")
         player_descs = computed.get("PlayerDescs", [])
 
-        # Players
+        # Players, as INSERT_PLAYER_SQL rows minus the leading replay_id
         players = []
         for i, p in enumerate(header.get("Players", [])):
             pd = player_descs[i] if i < len(player_descs) else {}
             loc = pd.get("StartLocation", {})
-            players.append({
-                "slot_id": p.get("SlotID"),
-                "name": p.get("Name", "Unknown"),
-                "race": p.get("Race", {}).get("Name", "Unknown"),
-                "is_human": p.get("Type", {}).get("Name") == "Human",
-                "start_x": loc.get("X"),
-                "start_y": loc.get("Y"),
-                "start_direction": pd.get("StartDirection"),
-            })
+            players.append((
+                p.get("SlotID"),
+                p.get("Name", "Unknown"),
+                p.get("Race", {}).get("Name", "Unknown"),
+                int(p.get("Type", {}).get("Name") == "Human"),
+                loc.get("X"),
+                loc.get("Y"),
+                pd.get("StartDirection"),
+                None,  # aurora_id, filled in from scrape metadata by ingest_new
+            ))
 
         return {
             "file_hash": fhash,
@@ -170,19 +278,18 @@ def process_replay(replay_path: Path) -> dict:
 
 def extract_match_id(file_name: str) -> str:
     """Extract MM-XXXXXXXX match_id from replay filename."""
-    m = re.search(r'(MM-[0-9A-Fa-f-]+)', file_name)
+    m = MATCH_ID_RE.search(file_name)
     return m.group(1) if m else None
 
 
-def insert_replay(c, result):
-    """Insert a processed replay and its players into the database."""
-    match_id = extract_match_id(result["file_name"])
-    c.execute('''
-        INSERT OR IGNORE INTO replays
-        (file_hash, file_path, file_name, source_dir, map_name,
-         game_date, duration_seconds, frames, version, winner_team, match_id, created_at)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    ''', (
+def insert_replays(c, results):
+    """Insert a batch of processed replays and all of their players.
+
+    One executemany per table instead of two statements per replay. Replay
+    ids are looked up by file_hash afterwards (lastrowid only covers the
+    last row). created_at is stamped by SQLite itself. Returns the replay
+    ids, in `results` order."""
+    c.executemany(INSERT_REPLAY_SQL, [(
         result["file_hash"],
         result["file_path"],
         result["file_name"],
@@ -193,63 +300,123 @@ def insert_replay(c, result):
         result["frames"],
         result["version"],
         result.get("winner_team"),
-        match_id,
-        datetime.now().isoformat()
-    ))
+        extract_match_id(result["file_name"])
+    ) for result in results])
+
+    hashes = [result["file_hash"] for result in results]
+    placeholders = ",".join(["?"] * len(hashes))
+    c.execute(f"SELECT file_hash, id FROM replays WHERE file_hash IN ({placeholders})", hashes)
+    id_by_hash = dict(c.fetchall())
+    replay_ids = [id_by_hash[h] for h in hashes]
 
-    replay_id = c.lastrowid
+    c.executemany(INSERT_PLAYER_SQL, [
+        (replay_id,) + p
+        for replay_id, result in zip(replay_ids, results) for p in result["players"]
+    ])
 
-    for p in result["players"]:
-        c.execute('''
-            INSERT INTO players (replay_id, slot_id, player_name, race, is_human,
-                                 start_x, start_y, start_direction, aurora_id)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (replay_id, p["slot_id"], p["name"], p["race"], p["is_human"],
-              p.get("start_x"), p.get("start_y"), p.get("start_direction"),
-              p.get("aurora_id")))
+    return replay_ids
 
-    return replay_id
+
+def split_known_replays(c, replays: list) -> tuple:
+    """Split replay paths into (to_process, already_ingested) by file name.
+
+    Only names carrying a match_id are unique enough to trust, so anything
+    else still goes through hashing; the file_hash check stays the fallback.
+    Known replays skip screp and hashing entirely."""
+    known_names = {name for (name,) in c.execute(
+        "SELECT file_name FROM replays WHERE match_id IS NOT NULL")}
+    to_process, known = [], []
+    for r in replays:
+        (known if r.name in known_names else to_process).append(r)
+    return to_process, known
+
+
+def hash_replay(path: Path) -> str:
+    """file_hash for split_duplicate_replays; None if unreadable (process_replay reports it)."""
+    try:
+        return file_hash(path)
+    except OSError:
+        return None
+
+
+def split_duplicate_replays(replays: list, existing_hashes: set) -> tuple:
+    """Hash replays and split off the duplicates, so they never reach screp.
+
+    File reads and hashlib both release the GIL, so a thread pool is enough;
+    small drops (under HASH_POOL_MIN) are hashed inline. New hashes are added
+    to `existing_hashes`, so a second copy within the same run counts as a
+    duplicate too. Returns (to_parse, their_hashes, duplicates)."""
+    if len(replays) < HASH_POOL_MIN:
+        replay_hashes = [hash_replay(path) for path in replays]
+    else:
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+            replay_hashes = list(pool.map(hash_replay, replays))
+
+    to_parse, hashes, duplicates = [], [], []
+    for path, h in zip(replays, replay_hashes):
+        if h is not None and h in existing_hashes:
+            duplicates.append(path)
+            continue
+        if h is not None:
+            existing_hashes.add(h)
+        to_parse.append(path)
+        hashes.append(h)
+    return to_parse, hashes, duplicates
 
 
 def ingest_directory(conn, directory: Path, max_workers: int = 4):
     """Ingest all replays from a directory."""
     c = conn.cursor()
 
-    replays = list(directory.rglob("*.rep"))
+    replays = list(iter_replay_paths(directory))
     print(f"Found {len(replays)} replays in {directory}")
 
-    c.execute("SELECT file_hash FROM replays")
-    existing_hashes = {row[0] for row in c.fetchall()}
+    # Built straight off the cursor, without an intermediate fetchall() list
+    existing_hashes = {h for (h,) in c.execute("SELECT file_hash FROM replays")}
+
+    replays, known = split_known_replays(c, replays)
+    replays, hashes, duplicates = split_duplicate_replays(replays, existing_hashes)
 
     processed = 0
-    skipped = 0
+    pending = []  # results waiting for the next insert_replays batch
+    skipped = len(known) + len(duplicates)
     errors = 0
 
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        futures = {executor.submit(process_replay, r): r for r in replays}
+    bulk = len(replays) >= BULK_REINDEX_MIN
+    if bulk:
+        drop_player_indexes(c)
 
-        for future in as_completed(futures):
-            result = future.result()
-
-            if result.get("error"):
-                errors += 1
-                if errors <= 5:
-                    print(f"  Error: {result['file_path']}: {result['error']}")
-                continue
-
-            if result["file_hash"] in existing_hashes:
-                skipped += 1
-                continue
+    # sqlite3 opens one transaction at the first INSERT; it is committed every
+    # COMMIT_EVERY replays and always on the way out, even on error, so rows
+    # already inserted are kept
+    try:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            for result in executor.map(process_replay, replays, hashes, chunksize=32):
+                if result.get("error"):
+                    errors += 1
+                    if errors <= 5:
+                        print(f"  Error: {result['file_path']}: {result['error']}")
+                    continue
 
-            insert_replay(c, result)
-            processed += 1
-            existing_hashes.add(result["file_hash"])
+                pending.append(result)
+                processed += 1
 
-            if processed % 100 == 0:
-                conn.commit()
-                print(f"  Processed {processed} replays...")
+                if len(pending) == INSERT_BATCH:
+                    insert_replays(c, pending)
+                    pending.clear()
+                    if processed % COMMIT_EVERY == 0:
+                        conn.commit()
+                if processed % 100 == 0:
+                    print(f"  Processed {processed} replays...")
 
-    conn.commit()
+        if pending:
+            insert_replays(c, pending)
+    finally:
+        if bulk:
+            print("  Rebuilding player indexes...")
+            create_player_indexes(c)
+        conn.commit()
+        leave_wal_mode(conn)
     print(f"\nCompleted: {processed} new, {skipped} duplicates, {errors} errors")
 
 
@@ -315,9 +482,30 @@ def load_scrape_metadata(to_ingest_dir: Path) -> dict:
     return metadata
 
 
+def move_replay(replay_path: Path, dest_dir: Path):
+    """Move a handled replay into dest_dir (or delete it if the name is taken)."""
+    dest = dest_dir / replay_path.name
+    if not dest.exists():
+        replay_path.rename(dest)
+    else:
+        replay_path.unlink()
+
+
+def flush_ingested(conn, batch: list, dest_dir: Path):
+    """Insert and commit a batch of (replay_path, result), then move the files.
+
+    Files only leave to_ingest once their rows are committed, so a crash can
+    never strand a moved replay that has no DB row."""
+    insert_replays(conn.cursor(), [result for _, result in batch])
+    conn.commit()
+    for replay_path, _ in batch:
+        move_replay(replay_path, dest_dir)
+    batch.clear()
+
+
 def ingest_new(conn, to_ingest_dir: Path, dest_dir: Path, max_workers: int = 4):
     """Ingest replays from to_ingest dir, then move them to dest dir."""
-    replays = list(to_ingest_dir.rglob("*.rep"))
+    replays = list(iter_replay_paths(to_ingest_dir))
     if not replays:
         print(f"No new replays in {to_ingest_dir}")
         return
@@ -329,55 +517,70 @@ def ingest_new(conn, to_ingest_dir: Path, dest_dir: Path, max_workers: int = 4):
     scrape_meta = load_scrape_metadata(to_ingest_dir)
 
     c = conn.cursor()
-    c.execute("SELECT file_hash FROM replays")
-    existing_hashes = {row[0] for row in c.fetchall()}
+    # Built straight off the cursor, without an intermediate fetchall() list
+    existing_hashes = {h for (h,) in c.execute("SELECT file_hash FROM replays")}
+
+    # Already-ingested names and hash duplicates are only moved (or dropped)
+    replays, known = split_known_replays(c, replays)
+    replays, hashes, duplicates = split_duplicate_replays(replays, existing_hashes)
+    for replay_path in known + duplicates:
+        move_replay(replay_path, dest_dir)
 
     processed = 0
-    skipped = 0
+    pending = []  # (replay_path, result) waiting for the next flush_ingested
+    skipped = len(known) + len(duplicates)
     errors = 0
 
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        futures = {executor.submit(process_replay, r): r for r in replays}
-
-        for future in as_completed(futures):
-            replay_path = futures[future]
-            result = future.result()
-            dest = dest_dir / replay_path.name
-
-            if result.get("error"):
-                errors += 1
-                if errors <= 5:
-                    print(f"  Error: {result['file_path']}: {result['error']}")
-            elif result["file_hash"] in existing_hashes:
-                skipped += 1
-            else:
-                # Attach aurora_ids from scrape metadata if available
-                meta = scrape_meta.get(replay_path.name, {})
-                if meta:
-                    for p in result["players"]:
-                        if p["name"] == meta.get("alias"):
-                            p["aurora_id"] = meta.get("aurora_id")
-                        elif p["name"] == meta.get("opponent_alias"):
-                            p["aurora_id"] = meta.get("opponent_aurora_id")
-
-                # Update file_path to destination before inserting
-                result["file_path"] = str(dest.absolute())
-                result["source_dir"] = dest_dir.name
-                insert_replay(c, result)
-                processed += 1
-                existing_hashes.add(result["file_hash"])
+    bulk = len(replays) >= BULK_REINDEX_MIN
+    if bulk:
+        drop_player_indexes(c)
 
-                if processed % 100 == 0:
-                    conn.commit()
-                    print(f"  Processed {processed} replays...")
-
-            # Move file to dest (or delete if duplicate name)
-            if not dest.exists():
-                replay_path.rename(dest)
-            else:
-                replay_path.unlink()
-
-    conn.commit()
+    # One transaction per INSERT_BATCH replays, and a batch's files are moved
+    # only after its commit. On error just the uncommitted batch is rolled
+    # back; its files are still in to_ingest for the next run
+    try:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            results = executor.map(process_replay, replays, hashes, chunksize=32)
+            for replay_path, result in zip(replays, results):
+                if result.get("error"):
+                    errors += 1
+                    if errors <= 5:
+                        print(f"  Error: {result['file_path']}: {result['error']}")
+                    move_replay(replay_path, dest_dir)
+                else:
+                    # Attach aurora_ids from scrape metadata if available
+                    meta = scrape_meta.get(replay_path.name, {})
+                    if meta:
+                        players = result["players"]
+                        for i, p in enumerate(players):
+                            # p[1] is the name, p[-1] the aurora_id
+                            if p[1] == meta.get("alias"):
+                                players[i] = p[:-1] + (meta.get("aurora_id"),)
+                            elif p[1] == meta.get("opponent_alias"):
+                                players[i] = p[:-1] + (meta.get("opponent_aurora_id"),)
+
+                    # Update file_path to destination before inserting
+                    result["file_path"] = str((dest_dir / replay_path.name).absolute())
+                    result["source_dir"] = dest_dir.name
+                    pending.append((replay_path, result))
+                    processed += 1
+
+                    if len(pending) == INSERT_BATCH:
+                        flush_ingested(conn, pending, dest_dir)
+                    if processed % 100 == 0:
+                        print(f"  Processed {processed} replays...")
+
+        if pending:
+            flush_ingested(conn, pending, dest_dir)
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        if bulk:
+            print("  Rebuilding player indexes...")
+            create_player_indexes(c)
+        conn.commit()
+        leave_wal_mode(conn)
 
     # Clean up metadata file after successful ingestion
     meta_path = to_ingest_dir / "_metadata.jsonl"
@@ -395,7 +598,7 @@ def main():
     data_dir = Path(__file__).parent / "data"
     to_ingest_dir = data_dir / "to_ingest"
 
-    if to_ingest_dir.exists() and any(to_ingest_dir.rglob("*.rep")):
+    if to_ingest_dir.exists() and has_replays(to_ingest_dir):
         # Fast path: only process new replays
         print(f"\n{'='*60}")
         print(f"Ingesting new replays from: {to_ingest_dir}")
@@ -10,7 +10,6 @@ Usage:
 
 import argparse
 import json
-import sqlite3
 import sys
 from collections import Counter
 from datetime import datetime
@@ -19,8 +18,8 @@ import numpy as np
 import joblib
 
 from features import (
-    DB_PATH, extract_player_samples, extract_player_samples_by_aurora,
-    apply_ngram_features,
+    DB_PATH, open_db, extract_player_samples, extract_player_samples_by_aurora,
+    apply_ngram_features, create_feature_matrix,
 )
 
 MODEL_PATH = DB_PATH.parent / "model.joblib"
@@ -64,7 +63,7 @@ def predict_samples(samples, model):
         apply_ngram_features(s["features"], s["raw_ngrams"], global_ngrams)
 
     # Build feature matrix and scale
-    X = np.array([[s["features"].get(f, 0) for f in feature_names] for s in samples])
+    X, _, _ = create_feature_matrix(samples, feature_names)
     X_scaled = scaler.transform(X)
 
     # Predict
@@ -345,7 +344,7 @@ def main():
     args = parser.parse_args()
 
     model = load_model()
-    conn = sqlite3.connect(DB_PATH)
+    conn = open_db(DB_PATH)
 
     if args.aurora_id:
         predict_by_aurora_id(conn, model, args.aurora_id)
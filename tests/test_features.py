@@ -0,0 +1,173 @@
+"""Tests for features.py."""
+
+from collections import Counter
+
+import joblib
+import numpy as np
+import pytest
+
+import features
+
+
+def test_failed_parse_is_not_cached(tmp_path, monkeypatch):
+    """A replay that fails once must come back on the next call, not stay []."""
+    monkeypatch.setattr(features, "cached_process_replay",
+                        joblib.Memory(tmp_path, verbose=0).cache(features.process_replay))
+
+    header = {
+        "Frames": 10000,
+        "Players": [{"ID": 0, "Name": "Flash", "Type": {"Name": "Human"},
+                     "Race": {"Name": "Terran"}}],
+    }
+    cols = {"frame": np.array([10, 20]), "player_id": np.array([0, 0])}
+    calls = []
+
+    def load_replay_columns(path):
+        calls.append(path)
+        if len(calls) == 1:
+            raise RuntimeError("screp failed (exit -9)")
+        return header, cols
+
+    monkeypatch.setattr(features, "load_replay_columns", load_replay_columns)
+    monkeypatch.setattr(features, "first_leave_frame", lambda cols: None)
+    monkeypatch.setattr(features, "select_columns", lambda cols, mask: cols)
+    monkeypatch.setattr(features, "extract_column_features",
+                        lambda cols, game_frames: ({"apm": 300.0}, {}))
+
+    args = ("a.rep", 1, "Flash", "Flash")
+    assert features.try_process_replay(*args) == []
+
+    samples = features.try_process_replay(*args)
+    assert [s["replay_id"] for s in samples] == [1]
+    assert samples[0]["features"] == {"apm": 300.0}
+
+    # The successful result is what got cached
+    assert features.try_process_replay(*args) == samples
+    assert len(calls) == 2
+
+
+# Fixed command list: one 13-command cycle (three Prod in a row, a lone Prod
+# after Build, hotkey groups 1/2) repeated with varying frame steps
+PATTERN = [
+    ("Hotkey", 3, {"Group": 1, "HotkeyType": {"Name": "Assign"}}),
+    ("Select", 5, {"UnitTags": [1, 2, 3]}),
+    ("Right Click", 8, {"Pos": {"X": 100, "Y": 200}}),
+    ("Train", 2, {}),
+    ("Train", 40, {}),
+    ("Unit Morph", 1, {}),
+    ("Hotkey", 6, {"Group": 2, "HotkeyType": {"Name": "Select"}}),
+    ("Build", 12, {"Pos": {"X": 1500, "Y": 300}}),
+    ("Train", 30, {"Queued": True}),
+    ("Stim", 4, {}),
+    ("Hotkey", 9, {"Group": 1, "HotkeyType": {"Name": "Select"}}),
+    ("Targeted Order", 15, {"Pos": {"X": 90, "Y": 2400}}),
+    ("Select Add", 7, {"UnitTags": [4]}),
+]
+GAME_FRAMES = 10000
+
+
+def make_commands(n=130, pattern=PATTERN):
+    commands, frame = [], 0
+    for i in range(n):
+        name, step, extra = pattern[i % len(pattern)]
+        frame += step * (1 + i % 3)
+        commands.append({"Frame": frame, "PlayerID": 0, "Type": {"Name": name}, **extra})
+    return commands
+
+
+def list_ngrams(tokens, n):
+    """The original list-based n-gram count (first-occurrence key order)."""
+    return Counter("_".join(tokens[i:i + n]) for i in range(len(tokens) - n + 1))
+
+
+def list_categories(commands):
+    """The original per-command abstraction + Prod collapse."""
+    return features.collapse_consecutive_prod(
+        [features.ACTION_CATEGORIES.get(c["Type"]["Name"], "O") for c in commands])
+
+
+# Output of the list-based extract_features on make_commands()
+EXPECTED_FEATURES = {
+    "gap_mean": 934.0930232558139, "gap_std": 1094.190878585208, "gap_median": 504,
+    "rapid_ratio": 0.07751937984496124, "moderate_ratio": 0.24031007751937986,
+    "slow_ratio": 0.5581395348837209, "burstiness": 1.1713939097536212,
+    "hotkey_diversity": 2, "hotkey_concentration": 1.0,
+    "hotkey_assign_ratio": 0.3333333333333333, "hotkey_action_ratio": 0.23076923076923078,
+    "primary_hotkey_group": 1,
+    "hk_tr_1_1": 0.47368421052631576, "hk_tr_1_2": 0.5263157894736842, "hk_tr_2_1": 1.0,
+    "dt_median_g0": 0, "dt_median_g1": 2268, "dt_median_g2": 0,
+    "dt_median_g3": 0, "dt_median_g4": 0, "dt_median_g5": 0,
+    "group_switch_median": 5250.0, "group_switch_mean": 4970.7,
+    "assign_order_1": -1, "assign_order_2": -1, "assign_order_3": -1,
+    "click_dist_mean": 2038.9772134446146, "click_dist_std": 488.30924659026243,
+    "click_dist_median": 2200.0227271553354, "small_move_ratio": 0.0, "big_jump_ratio": 1.0,
+    "early_apm": 64.0, "early_gap_mean": 931.6062992125984, "early_rapid_ratio": 0.07874015748031496,
+    "first_assign_0": 1, "first_assign_1": 1, "first_assign_2": 1,
+    "queued_ratio": 0.07692307692307693,
+    "select_size_mean": 3, "select_size_std": 0.0, "selection_action_ratio": 0.07692307692307693,
+    "select_add_ratio": 1.0, "select_gap_mean": 6319.894736842105, "select_gap_median": 9492,
+    "reselect_burst_ratio": 0.0, "sa_latency_mean": 1012.2, "sa_latency_median": 1008.0,
+    "burst_count_per_min": 2.4285714285714284, "burst_size_mean": 2,
+    "inter_burst_gap_mean": 1061.625, "autocorr_lag1": -0.2859146862679987,
+    "map_jumps_per_min": 0.0, "apm": 18.571428571428573, "apm_decay": 1.0,
+    "apm_variance": 29.49939466691284,
+    "pct_hotkey": 0.23076923076923078, "pct_right_click": 0.07692307692307693,
+    "pct_select": 0.07692307692307693, "pct_targeted_order": 0.07692307692307693,
+    "think_do_ratio": 2.0,
+}
+
+
+def test_extract_features_matches_list_based_output():
+    feats, raw_ngrams = features.extract_features(make_commands(), GAME_FRAMES)
+
+    assert feats == pytest.approx(EXPECTED_FEATURES, rel=1e-9, abs=1e-9)
+    assert sorted(raw_ngrams) == ["ehkg2", "ehkg3", "hkg2", "hkg3", "ng2", "ng3", "ng4"]
+
+    # Key order is first occurrence, so most_common ties keep the old order
+    ng2, total = raw_ngrams["ng2"]
+    assert total == 109
+    assert list(ng2.items()) == [
+        ("H_S", 10), ("S_R", 10), ("R_Prod", 10), ("Prod_H", 10), ("H_Bld", 10),
+        ("Bld_Prod", 10), ("Prod_Abl", 10), ("Abl_H", 10), ("H_TO", 10),
+        ("TO_S+", 10), ("S+_H", 9),
+    ]
+    hkg2, total = raw_ngrams["hkg2"]
+    assert total == 29
+    assert list(hkg2.items()) == [("1_2", 10), ("2_1", 10), ("1_1", 9)]
+
+    categories = list_categories(make_commands())
+    for n in [3, 4]:
+        ngrams, total = raw_ngrams[f"ng{n}"]
+        expected = list_ngrams(categories, n)
+        assert list(ngrams.items()) == list(expected.items())
+        assert total == sum(expected.values())
+
+
+@pytest.mark.parametrize("names", [
+    ["Train"],                                   # all Prod: collapses to one token
+    ["Train", "Unit Morph", "Hotkey"],           # run at the start of every cycle
+    ["Hotkey", "Select", "Train", "Train"],      # run at the end of every cycle
+    ["Train", "Hotkey"],                         # alternating, nothing to collapse
+    ["Build", "Train", "Building Morph", "Chat", "Train Fighter"],  # mixed Prod types
+])
+def test_prod_collapse_matches_list_based(names):
+    commands = make_commands(pattern=[(name, 10, {}) for name in names])
+    _, raw_ngrams = features.extract_features(commands, GAME_FRAMES)
+
+    categories = list_categories(commands)
+    for n in [2, 3, 4]:
+        expected = list_ngrams(categories, n)
+        if expected:
+            ngrams, total = raw_ngrams[f"ng{n}"]
+            assert list(ngrams.items()) == list(expected.items())
+            assert total == sum(expected.values())
+        else:
+            assert f"ng{n}" not in raw_ngrams
+
+
+def test_count_ngrams_first_occurrence_order():
+    tokens = ["B", "A", "B", "A", "C", "B", "A"]
+    assert list(features.count_ngrams(tokens, 2).items()) == [
+        ("B_A", 3), ("A_B", 1), ("A_C", 1), ("C_B", 1)]
+    assert list(features.count_ngrams(tokens, 3).items()) == list(list_ngrams(tokens, 3).items())
+    assert features.count_ngrams(tokens[:1], 2) == Counter()
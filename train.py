@@ -5,7 +5,6 @@ Train player fingerprint classifier and save model to disk.
 
 import argparse
 import json
-import sqlite3
 import sys
 from datetime import datetime
 from pathlib import Path
@@ -18,8 +17,8 @@ import joblib
 from collections import Counter
 
 from features import (
-    DB_PATH, extract_player_samples_by_aurora, get_pro_identities,
-    select_global_ngrams, apply_ngram_features, create_feature_matrix,
+    DB_PATH, open_db, extract_player_samples_by_aurora, get_pro_identities,
+    select_global_ngrams, compact_raw_ngrams, apply_ngram_features, create_feature_matrix,
 )
 
 MODEL_PATH = DB_PATH.parent / "model.joblib"
@@ -43,7 +42,7 @@ def main():
     print(f"TRAINING PLAYER FINGERPRINT CLASSIFIER (modern era: >={MIN_DATE}{cap_str})")
     print("=" * 70)
 
-    conn = sqlite3.connect(DB_PATH)
+    conn = open_db(DB_PATH)
 
     # Get all confirmed pros from player_identities (aurora_id-based)
     pros = get_pro_identities(conn, min_games=MIN_GAMES)
@@ -104,9 +103,14 @@ def main():
         print(f"  {prefix}: {len(grams)} global n-grams selected")
     print(f"  Total n-gram features: {total_ngram_features}")
 
+    # Drop every non-selected gram right away; rare grams dominate sample memory
+    for s in all_samples:
+        s["raw_ngrams"] = compact_raw_ngrams(s["raw_ngrams"], global_ngrams)
+
     # Apply global n-grams to all training samples
     for s in all_samples:
         apply_ngram_features(s["features"], s["raw_ngrams"], global_ngrams)
+        del s["raw_ngrams"]
 
     # Create feature matrix
     X, y, feature_names = create_feature_matrix(all_samples)
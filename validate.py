@@ -13,7 +13,6 @@ Modes:
 
 import argparse
 import json
-import sqlite3
 import sys
 from collections import Counter
 from pathlib import Path
@@ -21,8 +20,8 @@ import numpy as np
 import joblib
 
 from features import (
-    DB_PATH, extract_player_samples_by_aurora, get_pro_identities,
-    apply_ngram_features,
+    DB_PATH, open_db, extract_player_samples_by_aurora, get_pro_identities,
+    apply_ngram_features, create_feature_matrix,
 )
 
 MODEL_PATH = DB_PATH.parent / "model.joblib"
@@ -54,7 +53,7 @@ def main():
     feature_names = model["feature_names"]
     global_ngrams = model["global_ngrams"]
 
-    conn = sqlite3.connect(DB_PATH)
+    conn = open_db(DB_PATH)
     pros = get_pro_identities(conn, min_games=20)
 
     total_correct = 0
@@ -86,7 +85,7 @@ def main():
             apply_ngram_features(s["features"], s["raw_ngrams"], global_ngrams)
 
         # Build feature matrix
-        X = np.array([[s["features"].get(f, 0) for f in feature_names] for s in held_out])
+        X, _, _ = create_feature_matrix(held_out, feature_names)
         X_scaled = scaler.transform(X)
 
         if args.ensemble: